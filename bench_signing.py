@@ -0,0 +1,106 @@
+import argparse
+import binascii
+import hashlib
+import hmac
+import timeit
+
+from request_signer import RequestSigner
+
+# Microbenchmark of the EcoFlow request signing: the per-request code that
+# ecoflow_api.py used to repeat in every call against RequestSigner, for a
+# setpoint command, a selective quota query and large nested multi-device
+# payloads. Both produce identical signatures, which is checked first.
+#
+#   python bench_signing.py [--devices 32] [--repeat 5]
+
+ACCESS_KEY = 'Fp4SvIprYSDPXtYJidEtUAd1o'
+SECRET_KEY = 'WIbFEKre0s6sLnh4ei7SPUeYnptHG6V'
+NONCE = '345164'
+TIMESTAMP = '1671171709428'
+
+def legacy_hmac_sha256(data, key):
+    hashed = hmac.new(key.encode('utf-8'), data.encode('utf-8'), hashlib.sha256).digest()
+    return binascii.hexlify(hashed).decode('utf-8')
+
+def legacy_get_map(json_obj, prefix=""):
+    def flatten(obj, pre=""):
+        result = {}
+        if isinstance(obj, dict):
+            for k, v in obj.items():
+                result.update(flatten(v, f"{pre}.{k}" if pre else k))
+        elif isinstance(obj, list):
+            for i, item in enumerate(obj):
+                result.update(flatten(item, f"{pre}[{i}]"))
+        else:
+            result[pre] = obj
+        return result
+    return flatten(json_obj, prefix)
+
+def legacy_get_qstr(params):
+    return '&'.join([f"{key}={params[key]}" for key in sorted(params.keys())])
+
+def legacy_headers(params, nonce=NONCE, timestamp=TIMESTAMP):
+    headers = {'accessKey': ACCESS_KEY, 'nonce': nonce, 'timestamp': timestamp}
+    sign_str = (legacy_get_qstr(legacy_get_map(params)) + '&' if params else '') + legacy_get_qstr(headers)
+    headers['sign'] = legacy_hmac_sha256(sign_str, SECRET_KEY)
+    return headers
+
+def setpoint_command(sn='HW51ZOH4SF4E1234', watts=350):
+    return {"sn": sn, "cmdCode": "WN511_SET_PERMANENT_WATTS_PACK", "params": {"permanentWatts": watts * 10}}
+
+def quota_query(sn='HW51ZOH4SF4E1234'):
+    return {"sn": sn, "params": {"quotas": ["20_1.batSoc", "20_1.pv1InputWatts", "20_1.pv2InputWatts",
+                                            "20_1.permanentWatts"]}}
+
+def multi_device_payload(devices):
+    # one command carrying a nested schedule for every device
+    return {
+        "cmdCode": "SITE_SCHEDULE",
+        "devices": [
+            {
+                "sn": f"HW51ZOH4SF4E{number:04d}",
+                "params": {
+                    "permanentWatts": number * 10,
+                    "limits": {"min": 0, "max": 8000, "socFloor": 20},
+                    "schedule": [{"hour": hour, "watts": (hour * number) % 800, "enabled": hour % 2 == 0}
+                                 for hour in range(24)],
+                },
+            }
+            for number in range(devices)
+        ],
+    }
+
+def best_of(stmt, repeat, number):
+    return min(timeit.repeat(stmt, repeat=repeat, number=number)) / number
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark EcoFlow request signing")
+    parser.add_argument('--devices', type=int, default=32, help="devices in the large payload")
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    signer = RequestSigner(ACCESS_KEY, SECRET_KEY)
+    cases = [
+        ('setpoint command', setpoint_command(), 20000),
+        ('quota query', quota_query(), 20000),
+        (f'{args.devices}-device payload', multi_device_payload(args.devices), 50),
+    ]
+    for name, params, _ in cases:
+        if legacy_headers(params) != signer.headers(params, NONCE, TIMESTAMP):
+            raise SystemExit(f"signature mismatch for {name}")
+
+    print(f"{'case':24} {'legacy_us':>10} {'signer_us':>10} {'speedup':>8}")
+    for name, params, number in cases:
+        legacy = best_of(lambda: legacy_headers(params), args.repeat, number)
+        fast = best_of(lambda: signer.headers(params), args.repeat, number)
+        print(f"{name:24} {legacy * 1e6:10.1f} {fast * 1e6:10.1f} {legacy / fast:7.2f}x")
+
+    # one setpoint command per device, signed individually or as a batch
+    commands = [setpoint_command(f"HW51ZOH4SF4E{number:04d}", number) for number in range(args.devices)]
+    legacy = best_of(lambda: [legacy_headers(params) for params in commands], args.repeat, 500)
+    fast = best_of(lambda: signer.headers_batch(commands), args.repeat, 500)
+    name = f'batch of {args.devices} commands'
+    print(f"{name:24} {legacy * 1e6:10.1f} {fast * 1e6:10.1f} {legacy / fast:7.2f}x")
+
+if __name__ == "__main__":
+    main()
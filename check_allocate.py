@@ -0,0 +1,70 @@
+import argparse
+import time
+
+from powerstreams import PowerStream, allocate
+
+# Table-driven check of allocate(), the split of the site output across
+# several PowerStreams, plus a sweep over the site total: the shares always
+# add up to what the devices can take, and a 1 W step of the total moves no
+# device by more than a watt or two, so meter jitter never rewrites every
+# setpoint at once.
+#
+#   python check_allocate.py [--step 1]
+
+def device(sn, soc=None, max_limit=800, min_limit=0):
+    powerstream = PowerStream(sn)
+    powerstream.set_limits(min_limit, max_limit)
+    if soc is not None:
+        powerstream.telemetry.publish(time.time(), soc=soc)
+    return powerstream
+
+def mixed_site():
+    # a fuller battery, a small inverter and one with a minimum limit
+    return [device('a', soc=80), device('b', max_limit=100), device('c', min_limit=300)]
+
+CASES = [
+    ('single device', lambda: [device('a')], 350, {'a': 350}),
+    ('equal devices', lambda: [device('a', 50), device('b', 50)], 500, {'a': 250, 'b': 250}),
+    ('weighted by SoC', lambda: [device('a', 80), device('b', 20)], 500, {'a': 400, 'b': 100}),
+    ('capped device', lambda: [device('a', max_limit=100), device('b')], 900, {'a': 100, 'b': 800}),
+    ('above capacity', mixed_site, 2000, {'a': 800, 'b': 100, 'c': 800}),
+    ('negative total', mixed_site, -50, {'a': 0, 'b': 0, 'c': 0}),
+    ('minimums scaled down', mixed_site, 150, {'a': 0, 'b': 0, 'c': 150}),
+    ('just below the minimums', mixed_site, 299, {'a': 0, 'b': 0, 'c': 299}),
+    ('minimums covered', mixed_site, 300, {'a': 0, 'b': 0, 'c': 300}),
+    ('minimums plus water-fill', mixed_site, 600, {'a': 204, 'b': 16, 'c': 380}),
+]
+
+MAX_JUMP = 2  # W a device may move for a 1 W step of the total
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the split of the site output across devices")
+    parser.add_argument('--step', type=int, default=1, help="W between totals of the sweep")
+    args = parser.parse_args()
+
+    for name, site, total, expected in CASES:
+        result = allocate(total, site())
+        if result != expected:
+            raise SystemExit(f"{name}: allocate({total}) = {result}, expected {expected}")
+    print(f"table: {len(CASES)} cases match")
+
+    devices = mixed_site()
+    capacity = sum(device.max_limit for device in devices)
+    previous = None
+    for total in range(-100, capacity + 100, args.step):
+        shares = allocate(total, devices)
+        if sum(shares.values()) != min(max(total, 0), capacity):
+            raise SystemExit(f"sweep: allocate({total}) = {shares} does not add up")
+        for sn, watts in shares.items():
+            limit = next(device for device in devices if device.sn == sn).max_limit
+            if not 0 <= watts <= limit:
+                raise SystemExit(f"sweep: allocate({total}) gives {sn} {watts} W outside 0..{limit}")
+        if previous is not None:
+            jump = max(abs(shares[sn] - previous[sn]) for sn in shares)
+            if jump > MAX_JUMP * args.step:
+                raise SystemExit(f"sweep: allocate({total}) = {shares} jumps {jump} W from {previous}")
+        previous = shares
+    print(f"sweep: totals -100..{capacity + 100} W continuous")
+
+if __name__ == "__main__":
+    main()
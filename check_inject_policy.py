@@ -0,0 +1,90 @@
+import argparse
+import random
+
+from inject_policy import InjectPolicy, np
+
+# Randomised comparison of the default InjectPolicy against the hardcoded
+# get_inject_power_range() it replaced, for evaluate() and, with numpy, for
+# evaluate_batch() over the same series. SoC is drawn as the integer
+# percentages batSoc reports (or unknown); fractional SoC between 50 and 51
+# is the one place the two differ, the old code treated it as above 50.
+#
+#   python check_inject_policy.py [--samples 50000] [--seed 1]
+
+def legacy_inject_power_range(hour, soc, pv, car_charging, latched):
+    if 19 <= hour or hour < 7:
+        constant_max_power = 115
+    elif 7 <= hour <= 13:
+        constant_max_power = 800
+    else:
+        if soc is not None:
+            if soc < 30:
+                latched = True
+                constant_max_power = int(pv * 0.9)
+            elif latched and soc < 40:
+                constant_max_power = int(pv * 0.9)
+            else:
+                latched = False
+                if soc > 50:
+                    constant_max_power = 800
+                elif 41 <= soc <= 50:
+                    constant_max_power = max(int(pv * 0.9), 200)
+                else:
+                    constant_max_power = max(int(pv * 0.9), 99)
+        else:
+            constant_max_power = 800
+
+    max_power = constant_max_power
+    if car_charging > 10:
+        max_power = int(pv * 0.9)
+    if soc is not None and soc <= 17:
+        max_power = int(pv * 0.9)
+
+    if soc is not None and soc <= 85:
+        min_power = 0
+    else:
+        min_power = int(pv * 0.98)
+    return min_power, max_power, latched
+
+def random_samples(count, rng):
+    samples = []
+    for _ in range(count):
+        soc = rng.randint(0, 100) if rng.random() > 0.05 else None
+        samples.append((rng.randrange(24), soc, rng.randint(0, 1200), rng.choice([0, 0, 5, 10, 11, 3000])))
+    return samples
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the default injection policy with the old hardcoded one")
+    parser.add_argument('--samples', type=int, default=50000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    policy = InjectPolicy()
+    samples = random_samples(args.samples, random.Random(args.seed))
+
+    # a single series, so the SoC latch is carried from sample to sample
+    expected = []
+    legacy_latched = latched = False
+    for number, (hour, soc, pv, car_charging) in enumerate(samples):
+        legacy = legacy_inject_power_range(hour, soc, pv, car_charging, legacy_latched)
+        result = policy.evaluate(hour, soc, pv, car_charging, latched)
+        if result != legacy:
+            raise SystemExit(f"evaluate() differs at sample {number} {samples[number]}: {result} != {legacy}")
+        legacy_latched = latched = legacy[2]
+        expected.append(legacy)
+    print(f"evaluate():       {len(samples)} samples match")
+
+    if np is None:
+        print("evaluate_batch(): skipped, numpy is not installed")
+        return
+    hours, socs, pvs, car_charging = zip(*samples)
+    socs = [np.nan if soc is None else soc for soc in socs]
+    min_power, max_power, latch = policy.evaluate_batch(hours, socs, pvs, car_charging)
+    for number, legacy in enumerate(expected):
+        result = (int(min_power[number]), int(max_power[number]), bool(latch[number]))
+        if result != legacy:
+            raise SystemExit(f"evaluate_batch() differs at sample {number} {samples[number]}: {result} != {legacy}")
+    print(f"evaluate_batch(): {len(samples)} samples match")
+
+if __name__ == "__main__":
+    main()
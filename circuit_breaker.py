@@ -0,0 +1,90 @@
+import logging
+import threading
+import time
+
+import metrics
+
+# One breaker per external dependency (a meter, the EcoFlow REST API, the HA
+# broker). After failure_threshold consecutive failures it opens and calls
+# fail fast instead of each waiting for its own timeout. Once reset_timeout
+# has passed a single probe call is let through: success closes the breaker,
+# failure opens it again for twice as long, up to max_reset_timeout.
+
+DEFAULT_FAILURE_THRESHOLD = 3
+DEFAULT_RESET_TIMEOUT = 5  # seconds open before the first probe
+DEFAULT_MAX_RESET_TIMEOUT = 300
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+class CircuitOpenError(RuntimeError):
+    pass
+
+class CircuitBreaker:
+    def __init__(self, name, failure_threshold=DEFAULT_FAILURE_THRESHOLD, reset_timeout=DEFAULT_RESET_TIMEOUT,
+                 max_reset_timeout=DEFAULT_MAX_RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.open_for = reset_timeout
+        self.opened_at = 0
+        self.lock = threading.Lock()  # calls come from executor threads
+
+    @classmethod
+    def from_config(cls, name, config):
+        return cls(
+            name,
+            failure_threshold=config.get('breaker_failures', DEFAULT_FAILURE_THRESHOLD),
+            reset_timeout=config.get('breaker_reset_timeout', DEFAULT_RESET_TIMEOUT),
+            max_reset_timeout=config.get('breaker_max_reset_timeout', DEFAULT_MAX_RESET_TIMEOUT)
+        )
+
+    def allow(self):
+        # True if a call may go out now; in half-open state only the probe may
+        with self.lock:
+            if self.state == CLOSED:
+                return True
+            now = time.monotonic()
+            # a probe that never reported back does not block the next one
+            if now - self.opened_at >= self.open_for:
+                self.state = HALF_OPEN
+                self.opened_at = now
+                return True
+            metrics.inc('breaker_rejections', dependency=self.name)
+            return False
+
+    def record_success(self):
+        with self.lock:
+            if self.state != CLOSED:
+                logging.info("%s is answering again, circuit closed", self.name)
+            self.state = CLOSED
+            self.failures = 0
+            self.open_for = self.reset_timeout
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == HALF_OPEN:
+                self.open_for = min(self.open_for * 2, self.max_reset_timeout)
+            elif self.state == OPEN or self.failures < self.failure_threshold:
+                return
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+            metrics.inc('breaker_opened', dependency=self.name)
+            logging.warning("%s failed %s times in a row, circuit open for %ss", self.name, self.failures, self.open_for)
+
+    def call(self, func, *args, **kwargs):
+        # blocking helper: any exception of func counts as a failure
+        if not self.allow():
+            raise CircuitOpenError(f"{self.name}: circuit open")
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            self.record_failure()
+            raise
+        self.record_success()
+        return result
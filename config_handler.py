@@ -20,6 +20,6 @@ class ConfigHandler:
 
         return config
 
-    def get(self, key):
-        return self.config.get(key)
+    def get(self, key, default=None):
+        return self.config.get(key, default)
 
@@ -0,0 +1,132 @@
+import logging
+from collections import deque
+
+# Injection controllers. Each one turns a meter reading (positive = import
+# from the grid) and the current inverter output into a new output target
+# and keeps whatever state it needs between decisions. Select and tune them
+# in the 'controller' section of config.yaml.
+
+class Controller:
+    def __init__(self, settings, eps):
+        self.settings = settings
+        self.eps = settings.get('deadband', eps)
+
+    def update(self, power_in, base_value, min_power, max_power, pv=None, now=None):
+        raise NotImplementedError
+
+    def reset(self):
+        pass
+
+    @staticmethod
+    def clamp(value, max_power):
+        return int(max(min(value, max_power), 0))
+
+class IntegratorController(Controller):
+    # the original behaviour: add the full meter reading to the output
+    def update(self, power_in, base_value, min_power, max_power, pv=None, now=None):
+        injection_value = self.clamp(power_in + base_value, max_power)
+
+        if power_in < -self.eps:
+            new_injection_value = max(base_value + power_in, 0)
+            if base_value > 0:
+                injection_value = new_injection_value
+                logging.info("Adjusting injection to %s watts due to negative power consumption.", injection_value)
+        elif power_in > self.eps:
+            if injection_value != base_value:
+                logging.info("Increasing injection to %s watts due to positive power consumption.", injection_value)
+        return injection_value
+
+class FilteredPIController(Controller):
+    # PI controller in incremental form on a filtered meter reading: ki is
+    # the share of the remaining error corrected per decision, kp acts on the
+    # change of the error. Errors inside the deadband cause no change at all.
+    def __init__(self, settings, eps):
+        super().__init__(settings, eps)
+        self.kp = settings.get('kp', 0.3)
+        self.ki = settings.get('ki', 0.7)
+        self.target = settings.get('target', 0)
+        self.filter = settings.get('filter', 'ema')
+        self.alpha = settings.get('alpha', 0.5)
+        self.window = deque(maxlen=settings.get('window', 5))
+        self.reset()
+
+    def reset(self):
+        self.filtered = None
+        self.last_error = None
+        self.last_feedforward = 0
+        self.window.clear()
+
+    def filter_reading(self, power_in):
+        if self.filter == 'median':
+            self.window.append(power_in)
+            ordered = sorted(self.window)
+            middle = len(ordered) // 2
+            if len(ordered) % 2:
+                return ordered[middle]
+            return (ordered[middle - 1] + ordered[middle]) / 2
+        if self.filtered is None:
+            self.filtered = power_in
+        else:
+            self.filtered += self.alpha * (power_in - self.filtered)
+        return self.filtered
+
+    def feedforward(self, pv, now):
+        return 0
+
+    def update(self, power_in, base_value, min_power, max_power, pv=None, now=None):
+        error = self.filter_reading(power_in) - self.target
+        delta = self.ki * error
+        if self.last_error is not None:
+            delta += self.kp * (error - self.last_error)
+        self.last_error = error
+        # incremental form: only the change of the feed-forward term counts
+        feedforward = self.feedforward(pv, now)
+        delta += feedforward - self.last_feedforward
+        self.last_feedforward = feedforward
+        if abs(delta) <= self.eps:
+            return self.clamp(base_value, max_power)
+        return self.clamp(base_value + delta, max_power)
+
+class FeedForwardController(FilteredPIController):
+    # PI plus a feed-forward term on the PV trend: when generation moves, the
+    # PV-bound limits and the output the inverter can actually deliver from
+    # a low battery move with it, so the target is shifted ahead of the meter.
+    def __init__(self, settings, eps):
+        self.pv_gain = settings.get('pv_gain', 0.5)
+        self.pv_horizon = settings.get('pv_horizon', 10)
+        self.pv_alpha = settings.get('pv_alpha', 0.3)
+        super().__init__(settings, eps)
+
+    def reset(self):
+        super().reset()
+        self.last_pv = None
+        self.last_pv_time = None
+        self.pv_slope = 0
+
+    def feedforward(self, pv, now):
+        if pv is None or now is None:
+            return 0
+        if self.last_pv is None:
+            self.last_pv, self.last_pv_time = pv, now
+        elif pv != self.last_pv and now > self.last_pv_time:
+            # PV arrives less often than meter readings, so the slope is
+            # only updated when a new PV value shows up
+            slope = (pv - self.last_pv) / (now - self.last_pv_time)
+            self.pv_slope += self.pv_alpha * (slope - self.pv_slope)
+            self.last_pv, self.last_pv_time = pv, now
+        elif now - self.last_pv_time > self.pv_horizon * 3:
+            self.pv_slope = 0
+        return self.pv_gain * self.pv_slope * self.pv_horizon
+
+CONTROLLERS = {
+    'integrator': IntegratorController,
+    'pi': FilteredPIController,
+    'feedforward': FeedForwardController,
+}
+
+def create_controller(config):
+    settings = config.get('controller') or {}
+    kind = settings.get('type', 'integrator')
+    if kind not in CONTROLLERS:
+        raise ValueError(f"Unknown controller type: {kind}")
+    return CONTROLLERS[kind](settings, config.get('eps'))
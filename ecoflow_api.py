@@ -1,162 +1,315 @@
-import requests
-import hmac
-import hashlib
-import binascii
-import random
+import itertools
 import json
 import logging
+import random
 import time
+import threading
 import paho.mqtt.client as mqtt
 
+import metrics
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+from http_transport import HttpTransport
+from request_signer import RequestSigner
+
+DEFAULT_DEVICE_STATUS_TTL = 300
+MQTT_MAX_RECONNECT_DELAY = 60
+DEFAULT_MQTT_COMMAND_TIMEOUT = 5  # seconds to wait for a set_reply before falling back to REST
+# quota keys to query -> field names they are delivered as
+DEFAULT_QUOTA_KEYS = {
+    '20_1.batSoc': 'soc',
+    '20_1.pv1InputWatts': 'pv1_power',
+    '20_1.pv2InputWatts': 'pv2_power',
+    '20_1.permanentWatts': 'permanent_watts',
+}
+# quota name -> factor to watts, the PowerStream reports tenths of a watt
+QUOTA_SCALES = {
+    'pv1InputWatts': 0.1,
+    'pv2InputWatts': 0.1,
+    'permanentWatts': 0.1,
+    'invOutputWatts': 0.1,
+    'invDemandWatts': 0.1,
+}
+
+def command_succeeded(payload):
+    # the API answers HTTP 200 with a non-zero code if the command was rejected
+    return payload is not None and str(payload.get('code', '0')) == '0'
+
+def reply_succeeded(reply):
+    # set_reply carries data.ack, 0 meaning the device accepted the command
+    data = reply.get('data') or {}
+    return command_succeeded(reply) and not data.get('ack', 0)
+
+def parse_quotas(data, quota_keys):
+    # {quota key: raw value} -> {field: value in watts / percent}; keys may
+    # come with the "20_1." module prefix (REST) or without it (MQTT)
+    fields = {}
+    for key, field in quota_keys.items():
+        if key not in data:
+            continue
+        value = data[key]
+        scale = QUOTA_SCALES.get(key.rsplit('.', 1)[-1])
+        if scale is not None and value is not None:
+            value = value * scale
+        fields[field] = value
+    return fields
+
 class EcoFlowAPI:
-    def __init__(self, base_url, access_key, secret_key, serial_number, status_update_callback):
+    def __init__(self, base_url, access_key, secret_key, serial_number, status_update_callback, transport=None,
+                 device_status_ttl=DEFAULT_DEVICE_STATUS_TTL, quota_keys=None, mqtt_commands=False,
+                 mqtt_command_timeout=DEFAULT_MQTT_COMMAND_TIMEOUT, breaker=None):
         self.base_url = base_url
         self.access_key = access_key
         self.secret_key = secret_key
-        self.serial_number = serial_number
+        self.signer = RequestSigner(access_key, secret_key)
+        # one API object serves every PowerStream of the account; methods
+        # taking sn=None address the first one
+        self.serial_numbers = list(serial_number) if isinstance(serial_number, (list, tuple)) else [serial_number]
+        self.serial_number = self.serial_numbers[0]
         self.status_update_callback = status_update_callback
         self.mqtt_client = None
-
-    def hmac_sha256(self, data, key):
-        hashed = hmac.new(key.encode('utf-8'), data.encode('utf-8'), hashlib.sha256).digest()
-        sign = binascii.hexlify(hashed).decode('utf-8')
-        return sign
-
-    def get_map(self, json_obj, prefix=""):
-        def flatten(obj, pre=""):
-            result = {}
-            if isinstance(obj, dict):
-                for k, v in obj.items():
-                    result.update(flatten(v, f"{pre}.{k}" if pre else k))
-            elif isinstance(obj, list):
-                for i, item in enumerate(obj):
-                    result.update(flatten(item, f"{pre}[{i}]"))
-            else:
-                result[pre] = obj
-            return result
-        return flatten(json_obj, prefix)
-
-    def get_qstr(self, params):
-        return '&'.join([f"{key}={params[key]}" for key in sorted(params.keys())])
+        self.transport = transport or HttpTransport()
+        self.breaker = breaker or CircuitBreaker('EcoFlow REST')
+        self.device_status_ttl = device_status_ttl
+        self.device_status = {}  # sn -> (status, time)
+        self.device_status_lock = threading.Lock()
+        self.mqtt_certification = None
+        self.quota_keys = quota_keys or DEFAULT_QUOTA_KEYS
+        # the MQTT quota stream uses the names without module prefix
+        self.status_keys = {key.rsplit('.', 1)[-1]: field for key, field in self.quota_keys.items()}
+        self.last_status_time = 0
+        # commands over the cloud MQTT set topic, REST remains the fallback
+        self.mqtt_commands = mqtt_commands
+        self.mqtt_command_timeout = mqtt_command_timeout
+        self.mqtt_connected = False
+        self.mqtt_account = None
+        self.command_ids = itertools.count(random.randint(100000000, 899999999))
+        self.pending_commands = {}  # id -> [threading.Event, set_reply payload]
+        self.pending_commands_lock = threading.Lock()
+
+    def send(self, method, url, **kwargs):
+        # every REST call passes the breaker: while the cloud keeps failing,
+        # calls fail at once instead of each waiting for the transport timeout
+        if not self.breaker.allow():
+            raise CircuitOpenError(f"{self.breaker.name}: circuit open")
+        try:
+            response = self.transport.request(method, url, **kwargs)
+        except Exception:
+            self.breaker.record_failure()
+            raise
+        if response.status_code >= 500:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        return response
 
     def put_api(self, url, params=None):
-        nonce = str(random.randint(100000, 999999))
-        timestamp = str(int(time.time() * 1000))
-        headers = {'accessKey': self.access_key, 'nonce': nonce, 'timestamp': timestamp}
-        sign_str = (self.get_qstr(self.get_map(params)) + '&' if params else '') + self.get_qstr(headers)
-        headers['sign'] = self.hmac_sha256(sign_str, self.secret_key)
-        response = requests.put(url, headers=headers, json=params)
+        headers = self.signer.headers(params)
+        response = self.send('PUT', url, headers=headers, json=params)
         if response.status_code == 200:
             return response.json()
         else:
-            logging.error(f"put_api: {response.text}")
+            metrics.inc('http_errors')
+            logging.error("put_api: %s", response.text)
 
-    def get_api_quota_all(self):
+    def get_api_quota_all(self, sn=None):
+        sn = sn or self.serial_number
         url = self.base_url + 'iot-open/sign/device/quota/all'
-        params = {'sn': self.serial_number}
-        nonce = str(random.randint(100000, 999999))
-        timestamp = str(int(time.time() * 1000))
-        headers = {'accessKey': self.access_key, 'nonce': nonce, 'timestamp': timestamp}
-        sign_str = (self.get_qstr(self.get_map(params)) + '&' if params else '') + self.get_qstr(headers)
-        headers['sign'] = self.hmac_sha256(sign_str, self.secret_key)
-        response = requests.get(url + f"?sn={self.serial_number}", headers=headers)
+        params = {'sn': sn}
+        headers = self.signer.headers(params)
+        with metrics.timed('quota_poll'):
+            response = self.send('GET', url + f"?sn={sn}", headers=headers)
         if response.status_code == 200:
-            data = response.json()
-            with open('quota_response.json', 'w') as outfile:
-                json.dump(data, outfile, indent=4)
-            return data
+            return response.json()
         else:
-            logging.error(f"get_api: {response.text}")
+            metrics.inc('http_errors')
+            logging.error("get_api: %s", response.text)
+
+    def get_quotas(self, sn=None, quota_keys=None):
+        # selective quota query: only the listed keys are sent back, already
+        # mapped to their fields; None if the query failed
+        sn = sn or self.serial_number
+        quota_keys = quota_keys or self.quota_keys
+        url = self.base_url + 'iot-open/sign/device/quota'
+        with metrics.timed('quota_poll'):
+            response = self.post_api(url, {"sn": sn, "params": {"quotas": list(quota_keys)}})
+        if response is None:
+            return None
+        payload = response.json()
+        if not command_succeeded(payload) or not isinstance(payload.get('data'), dict):
+            logging.error("get_quotas: %s", payload)
+            return None
+        return parse_quotas(payload['data'], quota_keys)
 
     def get_api(self, url, params=None):
-        nonce = str(random.randint(100000, 999999))
-        timestamp = str(int(time.time() * 1000))
-        headers = {'accessKey': self.access_key, 'nonce': nonce, 'timestamp': timestamp}
-        sign_str = (self.get_qstr(self.get_map(params)) + '&' if params else '') + self.get_qstr(headers)
-        headers['sign'] = self.hmac_sha256(sign_str, self.secret_key)
-        response = requests.get(url, headers=headers, json=params)
+        headers = self.signer.headers(params)
+        response = self.send('GET', url, headers=headers, json=params)
         if response.status_code == 200:
             return response.json()
         else:
-            logging.error(f"get_api: {response.text}")
+            metrics.inc('http_errors')
+            logging.error("get_api: %s", response.text)
 
     def post_api(self, url, params=None):
-        nonce = str(random.randint(100000, 999999))
-        timestamp = str(int(time.time() * 1000))
-        headers = {'accessKey': self.access_key, 'nonce': nonce, 'timestamp': timestamp}
-        sign_str = (self.get_qstr(self.get_map(params)) + '&' if params else '') + self.get_qstr(headers)
-        headers['sign'] = self.hmac_sha256(sign_str, self.secret_key)
-        response = requests.post(url, headers=headers, json=params)
+        headers = self.signer.headers(params)
+        response = self.send('POST', url, headers=headers, json=params)
         if response.status_code == 200:
             return response
         else:
-            logging.error(f"post_api: {response.text}")
+            metrics.inc('http_errors')
+            logging.error("post_api: %s", response.text)
 
     def check_if_device_is_online(self, sn=None, payload=None):
         parsed_data = payload
         desired_device_sn = sn
 
-        device_found = False
-
         for device in parsed_data.get('data', []):
             if device.get('sn') == desired_device_sn:
-                device_found = True
                 online_status = device.get('online', 0)
                 if online_status == 1:
                     return "online"
                 else:
                     return "offline"
-        if not device_found:
-            logging.error(f"Device with SN '{desired_device_sn}' not found in the data.")
-            sys.exit(1)
-            return "devices not found"
+        logging.error("Device with SN '%s' not found in the data.", desired_device_sn)
+        return "devices not found"
+
+    # Device status cache - the device list only needs to be queried once per
+    # TTL, not on every setpoint write. One list query covers all devices.
+    def update_device_status(self, status, sn=None):
+        with self.device_status_lock:
+            self.device_status[sn or self.serial_number] = (status, time.time())
+
+    def invalidate_device_status(self, sn=None):
+        with self.device_status_lock:
+            self.device_status.pop(sn or self.serial_number, None)
+
+    def device_status_is_fresh(self, sn=None):
+        with self.device_status_lock:
+            entry = self.device_status.get(sn or self.serial_number)
+            return entry is not None and time.time() - entry[1] < self.device_status_ttl
+
+    def refresh_device_status(self, sn=None):
+        url = self.base_url + 'iot-open/sign/device/list'
+        with metrics.timed('device_list'):
+            payload = self.get_api(url, {"sn": self.serial_number})
+        if payload is None:
+            return None
+        statuses = {device_sn: self.check_if_device_is_online(device_sn, payload) for device_sn in self.serial_numbers}
+        for device_sn, status in statuses.items():
+            self.update_device_status(status, device_sn)
+        return statuses.get(sn or self.serial_number)
+
+    def get_device_status(self, sn=None):
+        with self.device_status_lock:
+            entry = self.device_status.get(sn or self.serial_number)
+        if entry is None or time.time() - entry[1] >= self.device_status_ttl:
+            return self.refresh_device_status(sn)
+        return entry[0]
 
-    def set_ef_powerstream_custom_load_power(self, NewPower):
-        logging.info(f"set_ef_powerstream_custom_load_power: NewPower {NewPower}")
+    def set_ef_powerstream_custom_load_power(self, NewPower, sn=None):
+        sn = sn or self.serial_number
+        logging.info("set_ef_powerstream_custom_load_power: %s NewPower %s", sn, NewPower)
 
-        url = 'https://api.ecoflow.com/iot-open/sign/device/quota'
-        url_device = 'https://api.ecoflow.com/iot-open/sign/device/list'
+        url = self.base_url + 'iot-open/sign/device/quota'
 
         cmdCode = 'WN511_SET_PERMANENT_WATTS_PACK'
-        PWR_MAX = 800
 
-        payload = self.get_api(url_device, {"sn": self.serial_number})
-        check_ps_status = self.check_if_device_is_online(self.serial_number, payload)
+        check_ps_status = self.get_device_status(sn)
+        if check_ps_status == "devices not found":
+            logging.error("Not setting power output, device '%s' unknown", sn)
+            return None
+        if check_ps_status == "offline":
+            logging.warning("Device '%s' reported offline, trying anyway", sn)
 
         # dynamic vs. permanentWatts!
-        quotas = ["20_1.permanentWatts"]
-        params = {"quotas": quotas}
+        params = {"permanentWatts": NewPower * 10 }
+        if self.mqtt_commands and self.mqtt_connected:
+            reply = self.send_mqtt_command(sn, cmdCode, params)
+            if reply is not None:
+                metrics.inc('setpoint_writes', transport='mqtt')
+                if not reply_succeeded(reply):
+                    logging.warning("Device '%s' rejected setpoint %s: %s", sn, NewPower, reply)
+                    self.invalidate_device_status(sn)
+                    return {'code': str((reply.get('data') or {}).get('ack', reply.get('code'))), 'reply': reply}
+                return {'code': '0', 'reply': reply}
+            metrics.inc('mqtt_command_fallbacks')
+            logging.warning("No set_reply from '%s' within %ss, falling back to REST", sn, self.mqtt_command_timeout)
 
         try:
-            logging.info(f"setting new power output: {NewPower}")
-            params = {"permanentWatts": NewPower * 10 }
-            payload = self.put_api(url, {"sn": self.serial_number, "cmdCode": cmdCode, "params": params})
+            logging.info("setting new power output: %s", NewPower)
+            with metrics.timed('setpoint_put'):
+                payload = self.put_api(url, {"sn": sn, "cmdCode": cmdCode, "params": params})
+            metrics.inc('setpoint_writes', transport='rest')
+            if not command_succeeded(payload):
+                # re-check the device on the next write instead of trusting the cache
+                self.invalidate_device_status(sn)
             return payload
 
         except Exception as e:
-            logging.error(f"Error fetching Ecoflow data: {str(e)}")
+            logging.error("Error fetching Ecoflow data: %s", e)
+            self.invalidate_device_status(sn)
             return None
 
-    def get_mqtt_certification(self):
-        url = self.base_url + 'iot-open/sign/certification'
-        json_data = self.get_api(url)
-        cert = json_data.get("data")
-        json.dumps(cert)
-        return cert
+    def send_mqtt_command(self, sn, cmd_code, params):
+        # publish on /open/<account>/<sn>/set and wait for the set_reply with
+        # the same id; None if it could not be sent or no reply arrived
+        command_id = next(self.command_ids)
+        message = {"id": command_id, "version": "1.0", "sn": sn, "cmdCode": cmd_code, "params": params}
+        waiter = [threading.Event(), None]
+        with self.pending_commands_lock:
+            self.pending_commands[command_id] = waiter
+        try:
+            with metrics.timed('setpoint_mqtt'):
+                info = self.mqtt_client.publish(f'/open/{self.mqtt_account}/{sn}/set', json.dumps(message), qos=1)
+                if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                    logging.error("Publishing %s to '%s' failed: %s", cmd_code, sn, mqtt.error_string(info.rc))
+                    return None
+                if not waiter[0].wait(self.mqtt_command_timeout):
+                    metrics.inc('mqtt_command_timeouts')
+                    return None
+            return waiter[1]
+        finally:
+            with self.pending_commands_lock:
+                self.pending_commands.pop(command_id, None)
+
+    def handle_set_reply(self, data):
+        try:
+            command_id = int(data.get('id'))
+        except (TypeError, ValueError):
+            return
+        with self.pending_commands_lock:
+            waiter = self.pending_commands.get(command_id)
+        if waiter is None:
+            # reply to a command that already timed out
+            metrics.inc('mqtt_late_replies')
+            return
+        waiter[1] = data
+        waiter[0].set()
+
+    def get_mqtt_certification(self, refresh=False):
+        # broker credentials are long-lived, only ask the API again when the
+        # broker rejects them
+        if self.mqtt_certification is None or refresh:
+            url = self.base_url + 'iot-open/sign/certification'
+            json_data = self.get_api(url)
+            if json_data is None:
+                raise RuntimeError("Failed to obtain EcoFlow MQTT certification")
+            self.mqtt_certification = json_data.get("data")
+        return self.mqtt_certification
 
     # MQTT-related methods
-    def connect_to_mqtt(self):
+    def connect_to_mqtt(self, client_id="rg_pwrMgmt"):
         # Get MQTT certification
         certification = self.get_mqtt_certification()
-        logging.info(f"MQTT Certification: {certification}")
+        logging.info("MQTT Certification for account %s", certification['certificateAccount'])
 
         broker_url = certification['url']
         broker_port = int(certification['port'])
         certificate_account = certification['certificateAccount']
         certificate_password = certification['certificatePassword']
+        self.mqtt_account = certificate_account
 
         # Create MQTT client instance
-        self.mqtt_client = mqtt.Client(client_id="rg_pwrMgmt")
+        self.mqtt_client = mqtt.Client(client_id=client_id)
         logging.debug("MQTT client created")
 
         # Set username and password
@@ -167,45 +320,83 @@ class EcoFlowAPI:
 
         # Enable detailed logging for the MQTT client
         self.mqtt_client.enable_logger(logging.getLogger(__name__))
+        # an exception in a callback would end the network thread and with it
+        # the quota stream; paho logs it and carries on instead
+        self.mqtt_client.suppress_exceptions = True
+
+        # paho reconnects on its own; back off up to a minute between attempts
+        self.mqtt_client.reconnect_delay_set(min_delay=1, max_delay=MQTT_MAX_RECONNECT_DELAY)
 
         # Define callback functions
         def on_connect(client, userdata, flags, rc):
             if rc == 0:
                 logging.info("Connected to MQTT broker successfully")
-                # Subscribe to the topic after successful connection
-                topic = f'/open/{certificate_account}/{self.serial_number}/quota'
-                print(f"TOPIC: {topic}")
-                client.subscribe(topic)
-                logging.info(f"Subscribed to topic: {topic}")
+                # Subscribe to the topics after successful connection
+                for sn in self.serial_numbers:
+                    topics = [f'/open/{certificate_account}/{sn}/quota']
+                    if self.mqtt_commands:
+                        topics.append(f'/open/{certificate_account}/{sn}/set_reply')
+                    for topic in topics:
+                        client.subscribe(topic)
+                        logging.info("Subscribed to topic: %s", topic)
+                self.mqtt_connected = True
             else:
-                logging.error(f"Failed to connect to MQTT broker. Return code {rc}")
+                logging.error("Failed to connect to MQTT broker. Return code %s", rc)
+                if rc in (mqtt.CONNACK_REFUSED_BAD_USERNAME_PASSWORD, mqtt.CONNACK_REFUSED_NOT_AUTHORIZED):
+                    # credentials were revoked - fetch new ones for the next attempt
+                    try:
+                        cert = self.get_mqtt_certification(refresh=True)
+                        client.username_pw_set(cert['certificateAccount'], cert['certificatePassword'])
+                    except Exception as e:
+                        logging.error("Failed to refresh MQTT certification: %s", e)
+
+        def on_disconnect(client, userdata, rc):
+            self.mqtt_connected = False
+            if rc != 0:
+                logging.warning("Unexpected disconnect from MQTT broker (%s), reconnecting", rc)
 
         def on_message(client, userdata, message):
-            payload = message.payload.decode("utf-8")
             try:
-                #print(f"userdata: {userdata}")
-                data = json.loads(payload)
-                params = data['param']
+                data = json.loads(message.payload)
+            except (json.JSONDecodeError, UnicodeDecodeError) as e:
+                logging.error("Failed to decode JSON payload: %s", e)
+                logging.error("Payload: %s", message.payload)
+                return
+            if not isinstance(data, dict):
+                logging.error("Unexpected MQTT payload on %s: %s", message.topic, message.payload)
+                return
+            # topic is /open/<account>/<sn>/quota or .../set_reply
+            sn, kind = message.topic.split('/')[-2:]
+            if kind == 'set_reply':
+                self.handle_set_reply(data)
+                return
+            # a quota message proves the device is online
+            self.update_device_status("online", sn)
+            params = data.get('param') or data.get('params') or {}
+            if not isinstance(params, dict):
+                logging.error("Unexpected quota parameters on %s: %s", message.topic, params)
+                return
+            # only pass on what the controller actually consumes, as fields
+            status = parse_quotas(params, self.status_keys)
+            if status:
+                self.last_status_time = time.time()
                 # Call the user-provided callback if it exists
                 if self.status_update_callback:
-                    self.status_update_callback(params)
-                print(json.dumps(data, indent=4))
-                #logging.info(f"Message received from topic {message.topic}")
-            except json.JSONDecodeError as e:
-                logging.error(f"Failed to decode JSON payload: {e}")
-                logging.error(f"Payload: {payload}")
+                    self.status_update_callback(status, sn)
 
         def on_log(client, userdata, level, buf):
-            logging.debug(f"MQTT Log: {buf}")
+            logging.debug("MQTT Log: %s", buf)
 
         # Assign callback functions
         self.mqtt_client.on_connect = on_connect
+        self.mqtt_client.on_disconnect = on_disconnect
         self.mqtt_client.on_message = on_message
         self.mqtt_client.on_log = on_log
 
-        # Connect to the broker
-        logging.info(f"Connecting to {broker_url}:{broker_port} with client ID rg_pwrMgmt")
-        self.mqtt_client.connect(broker_url, broker_port)
+        # Connect to the broker; connect_async lets the network loop retry
+        # even if the broker is unreachable right now
+        logging.info("Connecting to %s:%s with client ID %s", broker_url, broker_port, client_id)
+        self.mqtt_client.connect_async(broker_url, broker_port)
         logging.info("Connect command issued")
 
         # Start the network loop
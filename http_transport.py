@@ -0,0 +1,64 @@
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+DEFAULT_POOL_SIZE = 4
+DEFAULT_CONNECT_TIMEOUT = 3.05
+DEFAULT_READ_TIMEOUT = 10
+
+class HttpTransport:
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, keep_alive=True,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT, read_timeout=DEFAULT_READ_TIMEOUT):
+        self.pool_size = pool_size
+        self.keep_alive = keep_alive
+        self.timeout = (connect_timeout, read_timeout)
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            pool_size=config.get('http_pool_size', DEFAULT_POOL_SIZE),
+            keep_alive=config.get('http_keep_alive', True),
+            connect_timeout=config.get('http_connect_timeout', DEFAULT_CONNECT_TIMEOUT),
+            read_timeout=config.get('http_read_timeout', DEFAULT_READ_TIMEOUT)
+        )
+
+    def get_session(self, url):
+        # one persistent session (and connection pool) per scheme://host:port
+        parts = urlsplit(url)
+        origin = f"{parts.scheme}://{parts.netloc}"
+        with self.lock:
+            session = self.sessions.get(origin)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount(origin, adapter)
+                if not self.keep_alive:
+                    session.headers['Connection'] = 'close'
+                self.sessions[origin] = session
+        return session
+
+    def request(self, method, url, timeout=None, **kwargs):
+        session = self.get_session(url)
+        metrics.inc('http_requests', host=urlsplit(url).hostname)
+        return session.request(method, url, timeout=timeout or self.timeout, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def close(self):
+        with self.lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions.clear()
@@ -0,0 +1,239 @@
+import argparse
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Injection limits as data. The policy table from config.yaml (or the
+# built-in default, which is the long-standing hardcoded behaviour) is
+# compiled once into per-hour and per-SoC lookup tables. evaluate() serves
+# the live controller, evaluate_batch() runs the same policy over arrays of
+# recorded telemetry for offline what-if studies.
+
+DEFAULT_POLICY = {
+    # hour windows, first match wins, end is exclusive and may wrap midnight;
+    # a window either has a fixed max_power or defers to the SoC rules
+    'windows': [
+        {'start': 19, 'end': 7, 'max_power': 115},
+        {'start': 7, 'end': 14, 'max_power': 800},
+        {'start': 14, 'end': 19, 'soc_rules': True},
+    ],
+    'unknown_soc_max_power': 800,
+    # below 'below' % SoC the PV-only rule latches until SoC reaches 'release'
+    'soc_latch': {'below': 30, 'release': 40, 'pv_factor': 0.9},
+    # unlatched rules, first one with SoC above soc_above wins; a rule either
+    # has a fixed max_power or allows pv_factor * PV but at least floor
+    'soc_rules': [
+        {'soc_above': 50, 'max_power': 800},
+        {'soc_above': 40, 'pv_factor': 0.9, 'floor': 200},
+        {'pv_factor': 0.9, 'floor': 99},
+    ],
+    # independent of the hour: limit to PV while the car charges or the
+    # battery is nearly empty
+    'car_charging_above': 10,
+    'low_soc': 17,
+    'pv_cap_factor': 0.9,
+    # above full_soc (or with unknown SoC) at least full_pv_factor * PV has to
+    # be injected; works around PowerStream firmware misbehaving at max SoC
+    'full_soc': 85,
+    'full_pv_factor': 0.98,
+}
+
+SOC_STEPS = 101
+
+def merge_policy(spec):
+    # a partial spec overrides the default key by key, dict values like
+    # soc_latch one level deeper; the windows and soc_rules lists are
+    # replaced as a whole
+    merged = dict(DEFAULT_POLICY)
+    unknown = set(spec or {}) - set(DEFAULT_POLICY)
+    if unknown:
+        raise ValueError(f"inject_policy: unknown keys {sorted(unknown)}, use {sorted(DEFAULT_POLICY)}")
+    for key, value in (spec or {}).items():
+        if isinstance(DEFAULT_POLICY.get(key), dict):
+            if not isinstance(value, dict):
+                raise ValueError(f"inject_policy: {key} must be a mapping, not {value!r}")
+            unknown = set(value) - set(DEFAULT_POLICY[key])
+            if unknown:
+                raise ValueError(f"inject_policy: unknown {key} keys {sorted(unknown)}, use {sorted(DEFAULT_POLICY[key])}")
+            value = dict(DEFAULT_POLICY[key], **value)
+        merged[key] = value
+    return merged
+
+class InjectPolicy:
+    def __init__(self, spec=None):
+        spec = merge_policy(spec)
+        # hour -> fixed max power, or None to use the SoC rules
+        self.hour_max = [None] * 24
+        self.hour_soc = [False] * 24
+        assigned = [False] * 24
+        for window in spec['windows']:
+            if 'start' not in window or 'end' not in window:
+                raise ValueError(f"inject_policy: window {window} needs a start and an end hour")
+            if window.get('max_power') is None and not window.get('soc_rules'):
+                raise ValueError(f"inject_policy: window {window} needs a max_power or soc_rules: true")
+            hour = window['start'] % 24
+            while True:
+                if not assigned[hour]:
+                    assigned[hour] = True
+                    self.hour_soc[hour] = bool(window.get('soc_rules'))
+                    self.hour_max[hour] = window.get('max_power')
+                hour = (hour + 1) % 24
+                if hour == window['end'] % 24:
+                    break
+        for hour in range(24):
+            if not assigned[hour]:
+                raise ValueError(f"inject_policy: no window covers hour {hour}")
+        self.unknown_soc_max = spec['unknown_soc_max_power']
+
+        latch = spec['soc_latch']
+        self.latch_below = latch['below']
+        self.latch_release = latch['release']
+        self.latch_factor = latch['pv_factor']
+
+        # integer SoC -> (fixed max power or None, pv_factor, floor)
+        self.soc_rule = []
+        for value in range(SOC_STEPS):
+            for rule in spec['soc_rules']:
+                if 'soc_above' not in rule or value > rule['soc_above']:
+                    self.soc_rule.append((rule.get('max_power'), rule.get('pv_factor', 0), rule.get('floor', 0)))
+                    break
+            else:
+                raise ValueError(f"inject_policy: no SoC rule matches {value}%")
+
+        self.car_charging_above = spec['car_charging_above']
+        self.low_soc = spec['low_soc']
+        self.pv_cap_factor = spec['pv_cap_factor']
+        self.full_soc = spec['full_soc']
+        self.full_pv_factor = spec['full_pv_factor']
+        # SoC values at which the limits change, see near_soc_threshold()
+        self.soc_thresholds = sorted({self.latch_below, self.latch_release, self.low_soc, self.full_soc}
+                                     | {rule['soc_above'] for rule in spec['soc_rules'] if 'soc_above' in rule})
+
+        if np is not None:
+            self.hour_max_array = np.array([m if m is not None else 0 for m in self.hour_max])
+            self.hour_soc_array = np.array(self.hour_soc)
+            self.soc_fixed_array = np.array([r[0] if r[0] is not None else -1 for r in self.soc_rule])
+            self.soc_factor_array = np.array([r[1] for r in self.soc_rule], dtype=float)
+            self.soc_floor_array = np.array([r[2] for r in self.soc_rule])
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config.get('inject_policy'))
+
+    def evaluate(self, hour, soc, pv, car_charging, latched):
+        # returns (min_power, max_power, latched)
+        pv = pv or 0
+        if not self.hour_soc[hour]:
+            max_power = self.hour_max[hour]
+        elif soc is None:
+            max_power = self.unknown_soc_max
+        else:
+            if soc < self.latch_below:
+                latched = True
+            elif soc >= self.latch_release:
+                latched = False
+            if latched:
+                max_power = int(pv * self.latch_factor)
+            else:
+                fixed, factor, floor = self.soc_rule[min(max(int(soc), 0), SOC_STEPS - 1)]
+                max_power = fixed if fixed is not None else max(int(pv * factor), floor)
+
+        if car_charging > self.car_charging_above:
+            max_power = int(pv * self.pv_cap_factor)
+        if soc is not None and soc <= self.low_soc:
+            max_power = int(pv * self.pv_cap_factor)
+
+        if soc is not None and soc <= self.full_soc:
+            min_power = 0
+        else:
+            min_power = int(pv * self.full_pv_factor)
+        return min_power, max_power, latched
+
+    def near_soc_threshold(self, soc, margin):
+        return soc is not None and any(abs(soc - threshold) <= margin for threshold in self.soc_thresholds)
+
+    def evaluate_batch(self, hours, soc, pv, car_charging=None, latched=False):
+        # vectorized evaluate(); soc may contain NaN for unknown, the latch is
+        # carried through the series in order. Returns (min, max, latched).
+        if np is None:
+            raise RuntimeError("numpy is required for evaluate_batch()")
+        hours = np.asarray(hours, dtype=int)
+        soc = np.asarray(soc, dtype=float)
+        pv = np.nan_to_num(np.asarray(pv, dtype=float))
+        count = len(hours)
+        known = ~np.isnan(soc)
+        soc_window = self.hour_soc_array[hours]
+
+        # latch: set below latch_below, cleared from latch_release, otherwise
+        # held - forward fill the last decision
+        decisions = np.full(count, -1)
+        decisions[soc_window & known & (soc >= self.latch_release)] = 0
+        decisions[soc_window & known & (soc < self.latch_below)] = 1
+        positions = np.where(decisions >= 0, np.arange(count), -1)
+        positions = np.maximum.accumulate(positions)
+        latch = np.where(positions >= 0, decisions[np.maximum(positions, 0)], int(latched)).astype(bool)
+
+        soc_index = np.clip(np.nan_to_num(soc), 0, SOC_STEPS - 1).astype(int)
+        fixed = self.soc_fixed_array[soc_index]
+        by_rule = np.where(fixed >= 0, fixed,
+                           np.maximum(np.floor(pv * self.soc_factor_array[soc_index]), self.soc_floor_array[soc_index]))
+        by_soc = np.where(latch, np.floor(pv * self.latch_factor), by_rule)
+        by_soc = np.where(known, by_soc, self.unknown_soc_max)
+        max_power = np.where(soc_window, by_soc, self.hour_max_array[hours])
+
+        pv_cap = np.floor(pv * self.pv_cap_factor)
+        if car_charging is not None:
+            max_power = np.where(np.asarray(car_charging) > self.car_charging_above, pv_cap, max_power)
+        max_power = np.where(known & (soc <= self.low_soc), pv_cap, max_power)
+
+        min_power = np.where(known & (soc <= self.full_soc), 0, np.floor(pv * self.full_pv_factor))
+        return min_power.astype(int), max_power.astype(int), latch
+
+def local_hours(timestamps):
+    # local hour of day for unix timestamps, honouring DST changes per day
+    timestamps = np.asarray(timestamps, dtype=float)
+    days, inverse = np.unique((timestamps // 86400).astype(np.int64), return_inverse=True)
+    offsets = np.array([time.localtime(day * 86400 + 43200).tm_gmtoff for day in days])
+    return ((timestamps + offsets[inverse]) // 3600 % 24).astype(int)
+
+def what_if(policy, records):
+    # records as returned by telemetry_recorder.to_numpy(); the household
+    # load is approximately meter power plus the setpoint of the time
+    hours = local_hours(records['timestamp'])
+    pv = np.nan_to_num(records['pv1']) + np.nan_to_num(records['pv2'])
+    min_power, max_power, _ = policy.evaluate_batch(hours, records['soc'], pv)
+    load = np.nan_to_num(records['power_in']) + np.nan_to_num(records['setpoint'])
+    dt = np.diff(records['timestamp'], append=records['timestamp'][-1])
+    dt = np.clip(dt, 0, 300)
+    injected = np.clip(load, min_power, np.maximum(max_power, min_power))
+    return {
+        'samples': len(records),
+        'hours': round(dt.sum() / 3600, 1),
+        'mean_max_power_w': round(float(max_power.mean()), 1),
+        'injected_kwh': round(float((injected * dt).sum()) / 3.6e6, 2),
+        'grid_import_kwh': round(float((np.maximum(load - injected, 0) * dt).sum()) / 3.6e6, 2),
+        'forced_export_kwh': round(float((np.maximum(injected - load, 0) * dt).sum()) / 3.6e6, 2),
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Evaluate an injection policy over recorded telemetry")
+    parser.add_argument('recording', help="telemetry_recorder directory")
+    parser.add_argument('--config', help="config.yaml with the inject_policy to evaluate")
+    args = parser.parse_args()
+
+    from telemetry_recorder import to_numpy
+    spec = None
+    if args.config:
+        from config_handler import ConfigHandler
+        spec = ConfigHandler(args.config).get('inject_policy')
+    records = to_numpy(args.recording)
+    if not len(records):
+        raise SystemExit("no telemetry recorded")
+    start = time.perf_counter()
+    result = what_if(InjectPolicy(spec), records)
+    result['evaluation_s'] = round(time.perf_counter() - start, 3)
+    for key, value in result.items():
+        print(f"{key:18} {value}")
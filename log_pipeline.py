@@ -0,0 +1,134 @@
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+
+# Logging off the control loop: records go through a QueueHandler into a
+# queue, a QueueListener thread formats and writes them, so console or
+# journald I/O never blocks the caller. Messages use lazy %-style arguments
+# and are only formatted by the listener; repeated loop messages are rate
+# limited per message template before they are even queued.
+#
+# log_format selects the output: 'plain' (the message followed by any
+# extra= fields as key=value), 'kv' (time=... level=... logger=... msg="..."
+# plus the extra= fields) or 'json' (one object per line with the same keys).
+
+DEFAULT_LOG_FORMAT = 'plain'
+DEFAULT_RATE_LIMIT = 10  # records per message template and interval
+DEFAULT_RATE_INTERVAL = 60  # seconds
+MAX_RATE_WINDOWS = 1000  # templates tracked before expired windows are dropped
+
+# attributes every LogRecord has; anything else came in through extra=
+STANDARD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+def extra_fields(record):
+    return {key: value for key, value in vars(record).items() if key not in STANDARD_ATTRIBUTES}
+
+def format_value(value):
+    text = str(value)
+    if not text or any(c in text for c in ' ="'):
+        return json.dumps(text)
+    return text
+
+class PlainFormatter(logging.Formatter):
+    def format(self, record):
+        line = ' '.join([record.getMessage()] + [f"{key}={format_value(value)}"
+                                                for key, value in extra_fields(record).items()])
+        if record.exc_info:
+            line += '\n' + self.formatException(record.exc_info)
+        return line
+
+class KeyValueFormatter(logging.Formatter):
+    def format(self, record):
+        fields = {
+            'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        fields.update(extra_fields(record))
+        line = ' '.join(f"{key}={format_value(value)}" for key, value in fields.items())
+        if record.exc_info:
+            line += '\n' + self.formatException(record.exc_info)
+        return line
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        fields = {
+            'time': record.created,
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        fields.update(extra_fields(record))
+        if record.exc_info:
+            fields['exception'] = self.formatException(record.exc_info)
+        return json.dumps(fields, default=str)
+
+FORMATTERS = {
+    'plain': PlainFormatter,
+    'kv': KeyValueFormatter,
+    'json': JsonFormatter,
+}
+
+class RateLimitFilter(logging.Filter):
+    # at most `limit` records per (logger, message template) and interval;
+    # the first record after a suppressed stretch carries the count
+    def __init__(self, limit=DEFAULT_RATE_LIMIT, interval=DEFAULT_RATE_INTERVAL):
+        super().__init__()
+        self.limit = limit
+        self.interval = interval
+        self.windows = {}  # key -> [window start, records passed, records suppressed]
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        key = (record.name, str(record.msg))
+        now = time.monotonic()
+        with self.lock:
+            if len(self.windows) > MAX_RATE_WINDOWS:
+                # messages formatted before logging have a template each
+                self.windows = {k: w for k, w in self.windows.items() if now - w[0] < self.interval}
+            window = self.windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                suppressed = window[2] if window is not None else 0
+                window = self.windows[key] = [now, 0, 0]
+                if suppressed:
+                    record.suppressed = suppressed
+            if window[1] >= self.limit:
+                window[2] += 1
+                return False
+            window[1] += 1
+            return True
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    # the stock prepare() formats the message in the calling thread; in
+    # process the record can be queued as is and formatted by the listener
+    def prepare(self, record):
+        return record
+
+def setup_logging(config):
+    # replaces the handlers of the root logger; returns the started listener,
+    # stop() it on shutdown to flush what is still queued
+    handler = logging.StreamHandler(sys.stdout)
+    log_format = config.get('log_format', DEFAULT_LOG_FORMAT)
+    if log_format not in FORMATTERS:
+        raise ValueError(f"log_format must be one of {sorted(FORMATTERS)}, not '{log_format}'")
+    handler.setFormatter(FORMATTERS[log_format]())
+
+    records = queue.SimpleQueue()
+    queue_handler = DeferredQueueHandler(records)
+    if config.get('log_rate_limit', DEFAULT_RATE_LIMIT):
+        queue_handler.addFilter(RateLimitFilter(config.get('log_rate_limit', DEFAULT_RATE_LIMIT),
+                                                config.get('log_rate_interval', DEFAULT_RATE_INTERVAL)))
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(queue_handler)
+    root.setLevel(config.get('log_level', 'INFO'))
+
+    listener = logging.handlers.QueueListener(records, handler, respect_handler_level=True)
+    listener.start()
+    return listener
@@ -0,0 +1,200 @@
+import asyncio
+import json
+import logging
+
+import requests
+
+import metrics
+from circuit_breaker import CircuitBreaker
+
+# Net grid power from any number of meters: phase meters, sub-meters behind
+# the main one (heat pump, wallbox) and so on. Each source is read over HTTP,
+# pushed over MQTT, or both (HTTP as fallback while the stream is stale).
+# HTTP sources are fetched concurrently, each bounded by its own timeout and
+# circuit breaker, and the reading is the weighted sum over all sources with
+# a fresh value.
+
+DEFAULT_JSON_PATH = 'E320.Power_in'  # path of the power value below StatusSNS / tele SENSOR
+DEFAULT_TIMEOUT = 2  # seconds per HTTP fetch
+DEFAULT_STALE_AFTER = 5  # seconds a value (or MQTT stream) is trusted
+
+def get_json_path(data, path):
+    # resolve a dotted path like "E320.Power_in" inside a decoded JSON document
+    for key in path.split('.'):
+        if not isinstance(data, dict) or key not in data:
+            raise ValueError(f"'{path}' not found in meter data")
+        data = data[key]
+    return data
+
+def get_watts(data, path):
+    # null, an object or a non-numeric string where the reading should be
+    # is bad data like a missing key, not a crash
+    value = get_json_path(data, path)
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"'{path}' is not a number: {value!r}")
+
+class MeterSource:
+    def __init__(self, name, url=None, mqtt_topic=None, json_path=DEFAULT_JSON_PATH, weight=1,
+                 timeout=DEFAULT_TIMEOUT, stale_after=DEFAULT_STALE_AFTER, breaker=None):
+        self.name = name
+        self.url = url
+        self.mqtt_topic = mqtt_topic
+        self.json_path = json_path
+        self.weight = weight
+        self.timeout = timeout
+        self.stale_after = stale_after
+        self.value = None
+        self.value_time = 0
+        self.stream_time = 0
+        self.stream_stale = True
+        self.value_stale = False
+        self.fetch_future = None  # an HTTP fetch may outlive its timeout
+        self.breaker = breaker or CircuitBreaker(f"meter {name}")
+
+    def update(self, value, now, stream=False):
+        self.value = value
+        self.value_time = now
+        if stream:
+            self.stream_time = now
+
+    def is_fresh(self, now):
+        fresh = self.value is not None and now - self.value_time < self.stale_after
+        if fresh == self.value_stale:
+            self.value_stale = not fresh
+            if fresh:
+                logging.info("Meter %s is delivering again", self.name)
+            else:
+                metrics.inc('meter_source_stale', source=self.name)
+                logging.warning("Meter %s is stale, left out of the net power", self.name)
+        return fresh
+
+    def stream_is_fresh(self, now):
+        if self.mqtt_topic is None:
+            return False
+        fresh = now - self.stream_time < self.stale_after
+        if fresh == self.stream_stale:
+            self.stream_stale = not fresh
+            if fresh:
+                logging.info("MQTT telemetry of meter %s is live, HTTP polling suspended", self.name)
+            elif self.url:
+                logging.warning("MQTT telemetry of meter %s is stale, falling back to HTTP polling", self.name)
+        return fresh
+
+    def needs_poll(self, now):
+        return self.url is not None and self.fetch_future is None and not self.stream_is_fresh(now)
+
+    def reading_deadline(self, poll_interval):
+        # longest a healthy source goes without a new value: the stream's
+        # stale_after, then (with a url) one poll interval plus the fetch timeout
+        deadline = self.stale_after if self.mqtt_topic else 0
+        if self.url:
+            deadline += poll_interval + self.timeout
+        return deadline
+
+    def fetch(self, transport):
+        # blocking, runs in the executor
+        try:
+            with metrics.timed('meter_fetch'):
+                response = transport.get(self.url, timeout=self.timeout)
+                response.raise_for_status()
+            with metrics.timed('json_decode'):
+                data = response.json()
+                if 'StatusSNS' not in data:
+                    raise ValueError("Required data not found in the response")
+                return get_watts(data['StatusSNS'], self.json_path)
+        except requests.RequestException as e:
+            raise RuntimeError(f"{self.name}: HTTP request failed: {e}")
+        except ValueError as e:
+            raise RuntimeError(f"{self.name}: Data extraction error: {e}")
+
+    def parse_message(self, payload):
+        with metrics.timed('json_decode'):
+            data = json.loads(payload.decode("utf-8"))
+            return get_watts(data, self.json_path)
+
+class MeterAggregator:
+    def __init__(self, sources, transport):
+        self.sources = sources
+        self.transport = transport
+
+    @classmethod
+    def from_config(cls, config, transport):
+        specs = config.get('meters')
+        if not specs:
+            # the single meter configured by url / meter_source
+            mqtt_topic = config.get('meter_mqtt_topic') if config.get('meter_source', 'http') == 'mqtt' else None
+            specs = [{'name': 'meter', 'url': config.get('url'), 'mqtt_topic': mqtt_topic,
+                      'json_path': config.get('meter_json_path', DEFAULT_JSON_PATH),
+                      'stale_after': config.get('meter_stale_after', DEFAULT_STALE_AFTER),
+                      'timeout': config.get('meter_timeout', DEFAULT_TIMEOUT)}]
+        sources = []
+        for number, spec in enumerate(specs):
+            name = spec.get('name', f"meter{number}")
+            if not spec.get('url') and not spec.get('mqtt_topic'):
+                raise ValueError(f"meter {name} needs a url or an mqtt_topic")
+            sources.append(MeterSource(
+                name,
+                url=spec.get('url'),
+                mqtt_topic=spec.get('mqtt_topic'),
+                json_path=spec.get('json_path', config.get('meter_json_path', DEFAULT_JSON_PATH)),
+                weight=spec.get('weight', 1),
+                timeout=spec.get('timeout', config.get('meter_timeout', DEFAULT_TIMEOUT)),
+                stale_after=spec.get('stale_after', config.get('meter_stale_after', DEFAULT_STALE_AFTER)),
+                breaker=CircuitBreaker.from_config(f"meter {name}", config)
+            ))
+        return cls(sources, transport)
+
+    def needs_poll(self, now):
+        return any(source.needs_poll(now) for source in self.sources)
+
+    def reading_deadline(self, poll_interval):
+        return max(source.reading_deadline(poll_interval) for source in self.sources)
+
+    def net_power(self, now):
+        # weighted sum over the sources with a fresh value, None if there is none
+        fresh = [source for source in self.sources if source.is_fresh(now)]
+        if not fresh:
+            return None
+        return int(round(sum(source.weight * source.value for source in fresh)))
+
+    async def poll(self, now, force=False):
+        # fetch the sources not covered by a live MQTT stream (all HTTP
+        # sources with force) concurrently; returns (attempted, succeeded)
+        loop = asyncio.get_running_loop()
+        if force:
+            targets = [source for source in self.sources if source.url]
+        else:
+            targets = [source for source in self.sources if source.needs_poll(now)]
+        # a fetch still running is joined, the breaker only gates new ones
+        targets = [source for source in targets if source.fetch_future is not None or source.breaker.allow()]
+        results = await asyncio.gather(*(self.poll_source(loop, source, now) for source in targets))
+        return len(targets), sum(results)
+
+    async def poll_source(self, loop, source, now):
+        def fetch_done(future):
+            # once per fetch, however many reads joined it
+            source.fetch_future = None
+            if future.cancelled() or future.exception() is not None:
+                source.breaker.record_failure()
+            else:
+                source.breaker.record_success()
+
+        # a forced read joins a fetch that is already running
+        if source.fetch_future is None:
+            source.fetch_future = loop.run_in_executor(None, source.fetch, self.transport)
+            source.fetch_future.add_done_callback(fetch_done)
+        try:
+            # shielded: a fetch running late keeps its thread, but no longer
+            # holds up the reading of the other sources
+            value = await asyncio.wait_for(asyncio.shield(source.fetch_future), source.timeout)
+        except asyncio.TimeoutError:
+            metrics.inc('meter_timeouts', source=source.name)
+            logging.warning("Meter %s did not answer within %ss", source.name, source.timeout)
+            return False
+        except RuntimeError as e:
+            logging.error("Meter read failed: %s", e)
+            return False
+        source.update(value, now)
+        return True
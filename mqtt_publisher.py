@@ -0,0 +1,128 @@
+import json
+import logging
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+import metrics
+from circuit_breaker import CircuitBreaker
+
+DEFAULT_MIN_INTERVAL = 1.0
+
+class StatePublisher:
+    # Fields handed to publish() are merged per topic and sent by a worker
+    # thread, at most once per min_interval and only if they moved by more
+    # than their deadband. The caller never waits for the broker; while it is
+    # unreachable the fields stay pending and are sent once it is back.
+    def __init__(self, client, deadbands=None, min_interval=DEFAULT_MIN_INTERVAL, retain=False, breaker=None):
+        self.client = client
+        self.deadbands = deadbands or {}
+        self.min_interval = min_interval
+        self.retain = retain
+        self.breaker = breaker or CircuitBreaker('MQTT broker')
+        self.pending = {}  # topic -> fields merged since the last publish
+        self.published = {}  # topic -> last published value of every field
+        self.last_publish_time = {}  # topic -> monotonic time of last publish
+        self.condition = threading.Condition()
+        self.running = False
+        self.thread = None
+
+    @classmethod
+    def from_config(cls, client, config):
+        return cls(
+            client,
+            deadbands=config.get('publish_deadbands', {}),
+            min_interval=config.get('publish_min_interval', DEFAULT_MIN_INTERVAL),
+            retain=config.get('publish_retain', False),
+            breaker=CircuitBreaker.from_config('MQTT broker', config)
+        )
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='mqtt-publisher', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self.thread:
+            self.thread.join()
+
+    def publish(self, topic, fields):
+        with self.condition:
+            self.pending.setdefault(topic, {}).update(fields)
+            self.condition.notify()
+
+    def requeue(self, topic, fields):
+        # fields published meanwhile are newer and win
+        with self.condition:
+            self.pending[topic] = dict(fields, **self.pending.get(topic, {}))
+
+    def take_due(self):
+        # called with the condition held; pops all topics whose rate limit
+        # has expired and returns how long to wait for the next one
+        now = time.monotonic()
+        due = {}
+        wait = None
+        for topic in list(self.pending):
+            ready_at = self.last_publish_time.get(topic, 0) + self.min_interval
+            if ready_at <= now:
+                due[topic] = self.pending.pop(topic)
+            elif wait is None or ready_at - now < wait:
+                wait = ready_at - now
+        return due, wait
+
+    def changed_fields(self, topic, fields):
+        last = self.published.get(topic, {})
+        changed = {}
+        for key, value in fields.items():
+            if key in last:
+                previous = last[key]
+                if value == previous:
+                    continue
+                if isinstance(value, (int, float)) and isinstance(previous, (int, float)) \
+                        and abs(value - previous) <= self.deadbands.get(key, 0):
+                    continue
+            changed[key] = value
+        return changed
+
+    def send(self, topic, fields):
+        changed = self.changed_fields(topic, fields)
+        if not changed:
+            metrics.inc('publishes_suppressed')
+            return
+        if not self.breaker.allow():
+            self.requeue(topic, fields)
+            self.last_publish_time[topic] = time.monotonic()
+            return
+        state = dict(self.published.get(topic, {}), **changed)
+        # a retained message replaces the previous one, so it has to carry
+        # the complete state rather than just the fields that changed
+        payload = state if self.retain else changed
+        try:
+            with metrics.timed('publish'):
+                info = self.client.publish(topic, json.dumps(payload), retain=self.retain)
+            if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                raise RuntimeError(mqtt.error_string(info.rc))
+        except Exception as e:
+            logging.error("Failed to publish to %s: %s", topic, e)
+            self.breaker.record_failure()
+            self.requeue(topic, fields)
+        else:
+            self.breaker.record_success()
+            self.published[topic] = state
+        self.last_publish_time[topic] = time.monotonic()
+
+    def run(self):
+        while True:
+            with self.condition:
+                due, wait = self.take_due()
+                while self.running and not due:
+                    self.condition.wait(wait)
+                    due, wait = self.take_due()
+                if not self.running:
+                    return
+            for topic, fields in due.items():
+                self.send(topic, fields)
@@ -0,0 +1,95 @@
+import logging
+
+import metrics
+
+# Adaptive poll intervals for the sources that are polled rather than
+# pushed: the meter (ESP/Tasmota over HTTP) and the EcoFlow cloud quotas.
+# After a large change the source is polled at its floor; every calm poll
+# stretches the interval by backoff up to the ceiling. hurry() forces the
+# floor, e.g. near a policy threshold; idle() the idle interval (by default
+# the ceiling) while polling is pointless, e.g. at night.
+# An optional call budget (a token bucket refilled at budget per
+# budget_window seconds) caps the average rate, whatever the conditions.
+
+DEFAULT_BACKOFF = 1.5
+DEFAULT_BUDGET_WINDOW = 3600
+BUDGET_BURST = 0.1  # share of the budget that may be spent at once
+
+class AdaptivePoller:
+    def __init__(self, name, floor, ceiling, fast_change, idle_interval=None, backoff=DEFAULT_BACKOFF, budget=None,
+                 budget_window=DEFAULT_BUDGET_WINDOW):
+        if floor > ceiling:
+            raise ValueError(f"{name}: poll floor {floor}s above ceiling {ceiling}s")
+        self.name = name
+        self.floor = floor
+        self.ceiling = ceiling
+        self.idle_interval = idle_interval or ceiling
+        self.fast_change = fast_change  # change since the last poll that counts as fast
+        self.backoff = backoff
+        self.interval = floor
+        self.last_value = None
+        self.budget = budget
+        self.refill_rate = budget / budget_window if budget else None
+        self.capacity = max(budget * BUDGET_BURST, 1) if budget else None
+        self.tokens = self.capacity
+        self.tokens_time = None
+        self.throttled = False
+
+    @classmethod
+    def from_config(cls, name, config, floor, ceiling, fast_change, idle_interval=None):
+        # <name>_poll_floor, <name>_poll_ceiling, <name>_poll_idle, <name>_fast_change,
+        # <name>_poll_backoff, <name>_call_budget per <name>_budget_window
+        return cls(
+            name,
+            config.get(f"{name}_poll_floor", floor),
+            config.get(f"{name}_poll_ceiling", ceiling),
+            config.get(f"{name}_fast_change", fast_change),
+            idle_interval=config.get(f"{name}_poll_idle", idle_interval),
+            backoff=config.get(f"{name}_poll_backoff", DEFAULT_BACKOFF),
+            budget=config.get(f"{name}_call_budget"),
+            budget_window=config.get(f"{name}_budget_window", DEFAULT_BUDGET_WINDOW)
+        )
+
+    def observe(self, value):
+        # value is None if the poll brought nothing usable
+        if value is None:
+            return
+        if self.last_value is not None and abs(value - self.last_value) >= self.fast_change:
+            self.interval = self.floor
+        else:
+            self.interval = min(self.interval * self.backoff, self.ceiling)
+        self.last_value = value
+
+    def hurry(self):
+        self.interval = self.floor
+
+    def idle(self):
+        self.interval = self.idle_interval
+
+    def refill(self, now):
+        if self.tokens_time is not None:
+            self.tokens = min(self.tokens + (now - self.tokens_time) * self.refill_rate, self.capacity)
+        self.tokens_time = now
+
+    def spend(self, now, calls=1):
+        if self.budget:
+            self.refill(now)
+            self.tokens -= calls
+        metrics.inc('polls', calls, source=self.name)
+
+    def delay(self, now):
+        # seconds until the next poll: the adaptive interval, stretched while
+        # the budget is used up
+        if not self.budget:
+            return self.interval
+        self.refill(now)
+        wait = max((1 - self.tokens) / self.refill_rate, 0)
+        throttled = wait > self.interval
+        if throttled != self.throttled:
+            self.throttled = throttled
+            if throttled:
+                metrics.inc('poll_budget_exhausted', source=self.name)
+                logging.warning("%s call budget used up, polling every %.0fs", self.name, wait)
+            else:
+                logging.info("%s back within its call budget", self.name)
+        return max(self.interval, wait)
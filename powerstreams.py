@@ -0,0 +1,96 @@
+import math
+
+from state import Snapshot, StateStore, timestamped
+
+# Several PowerStreams behind one meter. The controller decides the output
+# of the whole site; allocate() splits it across the devices in proportion
+# to their headroom, weighted towards the fuller batteries. Every device
+# keeps its own SoC/PV state, policy latch and setpoint scheduler.
+
+DEFAULT_MAX_POWER = 800  # W, what a PowerStream can inject
+UNKNOWN_SOC_WEIGHT = 50  # treat a device without SoC as half full
+
+class DeviceTelemetry(Snapshot):
+    # written by the EcoFlow MQTT callback and the REST poll; permanent_watts
+    # is the setpoint the device itself reports
+    FIELDS = ('soc', 'pv1_power', 'pv2_power', 'total_power_generation', 'permanent_watts')
+    __slots__ = timestamped(FIELDS)
+
+    def derive(self):
+        if self.pv1_power is None or self.pv2_power is None:
+            self.total_power_generation = None
+        else:
+            self.total_power_generation = self.pv1_power + self.pv2_power
+            self.total_power_generation_time = max(self.pv1_power_time, self.pv2_power_time)
+
+class PowerStream:
+    def __init__(self, sn, max_power=DEFAULT_MAX_POWER):
+        self.sn = sn
+        self.max_power = max_power
+        self.telemetry = StateStore(DeviceTelemetry)
+        self.stream_time = 0  # last EcoFlow MQTT quota message, REST polls don't count
+        self.soc_below_30 = False
+        # policy limits of the current decision, see set_limits()
+        self.min_limit = 0
+        self.max_limit = max_power
+        self.scheduler = None
+
+    @classmethod
+    def from_config(cls, sn, config):
+        overrides = (config.get('devices') or {}).get(sn) or {}
+        return cls(sn, overrides.get('max_power', config.get('device_max_power', DEFAULT_MAX_POWER)))
+
+    def set_limits(self, min_power, max_power):
+        self.max_limit = max(min(max_power, self.max_power), 0)
+        self.min_limit = min(min_power, self.max_limit)
+
+    def output(self):
+        # what the inverter was last told, or is about to be told
+        if self.scheduler.confirmed is not None:
+            return self.scheduler.confirmed
+        return self.scheduler.requested
+
+    def stream_age(self, now):
+        return now - self.stream_time
+
+    def weight(self):
+        soc = self.telemetry.snapshot().soc
+        return max(soc if soc is not None else UNKNOWN_SOC_WEIGHT, 1)
+
+def allocate(total, devices):
+    # returns {sn: watts}; the shares add up to total unless every device
+    # is at its limit. Minimum limits (full batteries) are served first,
+    # scaled down in proportion while the total does not cover them all, the
+    # rest is water-filled: devices reaching their limit drop out and the
+    # others share their excess. The split is continuous in total, so meter
+    # jitter never moves every setpoint at once.
+    devices = list(devices)
+    min_total = sum(device.min_limit for device in devices)
+    scale = min(max(total, 0) / min_total, 1) if min_total > 0 else 0
+    shares = {device.sn: device.min_limit * scale for device in devices}
+    remaining = total - sum(shares.values())
+    headroom = {device.sn: device.max_limit - shares[device.sn] for device in devices}
+    open_devices = [device for device in devices if headroom[device.sn] > 0]
+    while remaining > 0 and open_devices:
+        weights = {device.sn: headroom[device.sn] * device.weight() for device in open_devices}
+        total_weight = sum(weights.values())
+        capped = [device for device in open_devices
+                  if shares[device.sn] + remaining * weights[device.sn] / total_weight >= device.max_limit]
+        if not capped:
+            for device in open_devices:
+                shares[device.sn] += remaining * weights[device.sn] / total_weight
+            break
+        for device in capped:
+            remaining -= device.max_limit - shares[device.sn]
+            shares[device.sn] = device.max_limit
+        open_devices = [device for device in open_devices if device not in capped]
+
+    # whole watts; the rounding remainder goes to the largest fractions
+    result = {sn: math.floor(share) for sn, share in shares.items()}
+    leftover = round(min(total, sum(shares.values()))) - sum(result.values())
+    for sn in sorted(shares, key=lambda sn: result[sn] - shares[sn]):
+        if leftover < 1:
+            break
+        result[sn] += 1
+        leftover -= 1
+    return result
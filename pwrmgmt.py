@@ -1,296 +1,672 @@
+import asyncio
 import time
-import traceback
 import json
 from datetime import datetime
 import paho.mqtt.client as mqtt
 import logging
-import threading
-import requests
 
-from ecoflow_api import EcoFlowAPI
+from ecoflow_api import EcoFlowAPI, DEFAULT_DEVICE_STATUS_TTL, DEFAULT_MQTT_COMMAND_TIMEOUT, MQTT_MAX_RECONNECT_DELAY, \
+    command_succeeded
+from circuit_breaker import CircuitBreaker
 from config_handler import ConfigHandler
-
-# Set up logging without the header
+from http_transport import HttpTransport
+import metrics
+from mqtt_publisher import StatePublisher
+from setpoint_scheduler import SetpointScheduler
+from controllers import create_controller
+from inject_policy import InjectPolicy
+from telemetry_recorder import TelemetryRecorder
+from powerstreams import PowerStream, DeviceTelemetry, allocate
+from meters import MeterAggregator
+from state import SiteState, StateStore, save_json_atomic, load_json
+from log_pipeline import setup_logging
+from supervisor import Supervisor
+from poll_scheduler import AdaptivePoller
+
+# Set up logging without the header; main() moves it off-thread, see log_pipeline.py
 logging.basicConfig(level=logging.INFO, format='%(message)s')
 
+SOC_POLL_INTERVAL = 20  # fastest SoC/PV polling of the EcoFlow cloud (cloud_poll_floor)
+SOC_POLL_CEILING = 300  # slowest, when PV is stable or at night (cloud_poll_ceiling)
+PV_FAST_CHANGE = 100  # watts of PV change between polls that keep cloud polling fast
+SOC_THRESHOLD_MARGIN = 3  # percent SoC around a policy threshold that keeps cloud polling fast
+METER_POLL_FLOOR = 1  # fastest meter polling (meter_poll_floor), slowest is sleep_time
+METER_POLL_IDLE = 5  # meter polling while the output is pinned at a limit (meter_poll_idle)
+STALL_CHECK_INTERVAL = 0.5  # seconds between checks for a stalled meter reading
+DEFAULT_POLL_DEADLINE = 15  # seconds an EcoFlow poll (device list and quotas) may take
+HEARTBEAT_MARGIN = 1  # seconds of slack on top of a worker's longest regular iteration
+DEFAULT_TELEMETRY_STALE_AFTER = 60  # seconds without EcoFlow MQTT telemetry before REST polling resumes
+DEFAULT_STATE_SAVE_INTERVAL = 60  # seconds between state_file saves, setpoint changes save at once
+DEFAULT_STATE_MAX_AGE = 900  # seconds a saved setpoint and latch are trusted at boot
+
 # Global variables
-last_injection_value = 1  # Initialize the last injection value to 1
-soc = None
-soc_mqtt = -1
-pv1_power = None
-pv2_power = None
-total_power_generation = None
-soc_below_30 = False
-injection_permitted = True  # New variable to store injection permission
-last_soc_check_time = 0
-last_power_in_check_time = 0
-car_charging = 0
-current_power = 0  # Global variable to store the current power
+last_injection_value = 1  # Initialize the last injection value to 1 (site total)
+# meter reading, HA commands and site-wide SoC (mean) / PV (sums), see state.py
+site = StateStore(SiteState)
+devices = {}  # sn -> PowerStream, set up by run_controller
 config_handler = None
+http_transport = None
+meter = None  # MeterAggregator over the configured meter sources
+state_publisher = None
+recorder = None
+controller = None
+inject_policy = InjectPolicy()
+event_loop = None  # asyncio loop of the controller, set by run_controller
+events = None  # asyncio.Queue of (kind, value) events for processing_loop
+state_dirty = None  # asyncio.Event, set when the state_file needs saving
+meter_poller = None  # AdaptivePoller of the HTTP meter sources, set by run_controller
+cloud_poller = None  # AdaptivePoller of the EcoFlow REST quota polls
+
+def mark_state_dirty():
+    if state_dirty is not None:
+        state_dirty.set()
+
+def post_event(kind, value=None):
+    # safe to call from any thread, e.g. paho's network thread
+    if event_loop is not None:
+        event_loop.call_soon_threadsafe(events.put_nowait, (kind, value))
 
 def on_message(client, userdata, message):
-    global injection_permitted, car_charging
     try:
         payload = json.loads(message.payload.decode("utf-8"))
-        injection_permitted = payload.get("injection_permitted", True)
-        car_charging = payload.get("car_charging", 0)
-        logging.info(f"MQTT message received: injection_permitted = {injection_permitted}, car_charging {car_charging}")
-    except json.JSONDecodeError as e:
-        logging.error(f"Failed to decode JSON from MQTT message: {e}")
+        if not isinstance(payload, dict):
+            raise ValueError(f"expected a JSON object, got {payload!r}")
+        snapshot = site.publish(time.time(), injection_permitted=payload.get("injection_permitted", True),
+                                car_charging=payload.get("car_charging", 0))
+        logging.info("MQTT message received: injection_permitted = %s, car_charging %s",
+                     snapshot.injection_permitted, snapshot.car_charging)
+        post_event('ha_command', payload)
+    except (UnicodeDecodeError, ValueError) as e:
+        logging.error("Failed to decode JSON from MQTT message: %s", e)
+
+def on_meter_message(client, userdata, message, source=None):
+    try:
+        value = source.parse_message(message.payload)
+    except (UnicodeDecodeError, ValueError) as e:
+        logging.error("Failed to extract meter reading from %s: %s", message.topic, e)
+        return
+    now = time.time()
+    source.update(value, now, stream=True)
+    power_in = meter.net_power(now)
+    if power_in is None:
+        return
+    process_power_in(power_in, client)
+    post_event('power_in', power_in)
+
+def on_connect(client, userdata, flags, rc):
+    # (re-)subscribe on every connect so that automatic reconnects keep working
+    if rc == 0:
+        for topic in userdata['topics']:
+            client.subscribe(topic)
+    else:
+        logging.error("Failed to connect to MQTT broker. Return code %s", rc)
 
 def setup_mqtt_client(config):
-    client = mqtt.Client(client_id='rg_pwrMgmt')
+    topics = ["HA-to-rg_PwrMgmt"]
+    client = mqtt.Client(client_id='rg_pwrMgmt', userdata={'topics': topics})
+    client.on_connect = on_connect
     client.on_message = on_message
-    client.connect(config.get('MQTT_BROKER_ADDRESS'), config.get('MQTT_PORT'), 60)
-    client.subscribe("HA-to-rg_PwrMgmt")
+    client.reconnect_delay_set(min_delay=1, max_delay=MQTT_MAX_RECONNECT_DELAY)
+    # a callback exception must not end the network thread that carries HA
+    # commands, the meter stream and every publish
+    client.enable_logger(logging.getLogger('paho'))
+    client.suppress_exceptions = True
+    for source in meter.sources:
+        if source.mqtt_topic:
+            topics.append(source.mqtt_topic)
+            client.message_callback_add(
+                source.mqtt_topic,
+                lambda client, userdata, message, source=source: on_meter_message(client, userdata, message, source))
+    # connect_async: a broker that is down or does not resolve at boot is
+    # retried by the network loop instead of ending the controller
+    client.connect_async(config.get('MQTT_BROKER_ADDRESS'), config.get('MQTT_PORT'), 60)
     return client
 
 def publish_to_mqtt(client, topic, payload):
-    client.publish(topic, json.dumps(payload))
-
-def update_soc(new_soc):
-    global soc
-    soc = new_soc
-
-def on_status_update(params):
-    global soc_mqtt, soc, pv1_power, pv2_power, total_power_generation, mqtt_client
-    #print(f'pv1: {params["pv1InputWatts"]}, pv2: {params["pv2InputWatts"]}')
-    #print(f'number params: {len(params)}')
-    soc = params.get("batSoc")
-    if soc is not None:
-        soc_mqtt = soc
-    pv1_power = params.get("pv1InputWatts")
-    pv2_power = params.get("pv2InputWatts")
-    prev_total = total_power_generation
-    if pv1_power is not None and pv2_power is not None:
-        pv1_power /= 10
-        pv2_power /= 10
-        total_power_generation = int(pv1_power + pv2_power)
-    #else:
-        #print("MQTT: did not modify total_power_generation, got no data")
-        #total_power_generation = None
-    print(f"EF MQTT CALLBACK: pv1 {pv1_power}, total PV: {total_power_generation}, soc: {soc_mqtt}")
-    # Publish updated data to HA
-    if total_power_generation is not None and prev_total != total_power_generation:
-        payload = {
-            "PV_total": int(total_power_generation)
-        }
+    # hand off to the coalescing publisher so a slow broker never stalls the caller
+    if state_publisher is not None:
+        state_publisher.publish(topic, payload)
+    else:
+        client.publish(topic, json.dumps(payload))
+
+def total_of(values):
+    values = [value for value in values if value is not None]
+    return sum(values) if values else None
+
+def site_totals(snapshot):
+    telemetry = [device.telemetry.snapshot() for device in devices.values()]
+    known_soc = [device.soc for device in telemetry if device.soc is not None]
+    return {
+        'soc': sum(known_soc) / len(known_soc) if known_soc else None,
+        'pv1_power': total_of(device.pv1_power for device in telemetry),
+        'pv2_power': total_of(device.pv2_power for device in telemetry),
+        'total_power_generation': total_of(device.total_power_generation for device in telemetry)
+    }
+
+def update_site_totals():
+    return site.update(time.time(), site_totals)
+
+def publish_soc_pv(mqtt_client):
+    snapshot = site.snapshot()
+    payload = {}
+    if snapshot.soc is not None:
+        payload["SoC"] = int(snapshot.soc)
+    if snapshot.total_power_generation is not None:
+        payload["PV1"] = int(snapshot.pv1_power)
+        payload["PV2"] = int(snapshot.pv2_power)
+        payload["PV_total"] = int(snapshot.total_power_generation)
+    if len(devices) > 1:
+        for device in devices.values():
+            telemetry = device.telemetry.snapshot()
+            if telemetry.soc is not None:
+                payload[f"SoC_{device.sn}"] = int(telemetry.soc)
+            if telemetry.total_power_generation is not None:
+                payload[f"PV_total_{device.sn}"] = int(telemetry.total_power_generation)
+    if payload:
         publish_to_mqtt(mqtt_client, 'rg_PwrMgmt-to-HA', payload)
 
+def on_status_update(fields, sn=None):
+    global mqtt_client
+    device = devices.get(sn) if sn else next(iter(devices.values()), None)
+    if device is None:
+        return
+    # quota messages are partial, only the fields present are touched
+    device.stream_time = time.time()
+    telemetry = device.telemetry.publish(device.stream_time, **fields)
+    update_site_totals()
+    logging.debug("EF MQTT CALLBACK %s: pv1 %s, total PV: %s, soc: %s",
+                  device.sn, telemetry.pv1_power, telemetry.total_power_generation, telemetry.soc)
+    # Publish updated data to HA
+    publish_soc_pv(mqtt_client)
+    post_event('telemetry', fields)
 
-
-def update_and_get_soc(ecoflow_api, mqtt_client):
-    global soc, pv1_power, pv2_power, total_power_generation
+def update_and_get_soc(ecoflow_api, mqtt_client, device):
     try:
-        soc_response = ecoflow_api.get_api_quota_all()
-        if 'data' in soc_response:
-            soc = soc_response['data'].get('20_1.batSoc', None)
-            pv1_power = soc_response['data'].get('20_1.pv1InputWatts', None)
-            pv2_power = soc_response['data'].get('20_1.pv2InputWatts', None)
-            if pv1_power is not None and pv2_power is not None:
-                pv1_power /= 10
-                pv2_power /= 10
-                total_power_generation = pv1_power + pv2_power
-            else:
-                total_power_generation = None
-            logging.info(f"SoC: {soc}%, PV1: {pv1_power}W, PV2: {pv2_power}W, Total: {total_power_generation}W")
-            
-            # Publish SoC and PV data to MQTT
-            payload = {
-                "SoC": int(soc),
-                "PV1": int(pv1_power),
-                "PV2": int(pv2_power),
-                "PV_total": int(total_power_generation)
-            }
-            publish_to_mqtt(mqtt_client, 'rg_PwrMgmt-to-HA', payload)
-        else:
-            logging.warning("SoC data not found in the response")
-            soc = pv1_power = pv2_power = total_power_generation = None
+        # only the configured quota keys, not the whole quota/all document
+        fields = ecoflow_api.get_quotas(device.sn)
+        if fields is not None:
+            # keys missing from the answer are unknown now
+            fields = dict(dict.fromkeys(ecoflow_api.quota_keys.values()), **fields)
+            telemetry = device.telemetry.publish(time.time(), **fields)
+            logging.info("%s SoC: %s%%, PV1: %sW, PV2: %sW, Total: %sW", device.sn, telemetry.soc,
+                         telemetry.pv1_power, telemetry.pv2_power, telemetry.total_power_generation)
+            return
+        logging.warning("SoC data of %s not found in the response", device.sn)
     except Exception as e:
-        logging.error(f"Failed to update SoC: {e}")
-        soc = pv1_power = pv2_power = total_power_generation = None
-
-def get_inject_power_range():
-    global soc, soc_below_30, injection_permitted, total_power_generation, car_charging
-
-    current_hour = datetime.now().hour
-    if 19 <= current_hour or current_hour < 7:
-        constant_max_power = 115
-    elif 7 <= current_hour <= 13: # This means between 7:00 and 13:59!
-        constant_max_power = 800
-    else:
-        if soc is not None:
-            if soc < 30:
-                soc_below_30 = True
-                constant_max_power = int(total_power_generation * 0.9)
-            elif soc_below_30 and soc < 40:
-                constant_max_power = int(total_power_generation * 0.9)
-            else:
-                soc_below_30 = False
-                if soc > 50:
-                    constant_max_power = 800
-                elif 41 <= soc <= 50:
-                    constant_max_power = max(int(total_power_generation * 0.9), 200)
-                else:
-                    constant_max_power = max(int(total_power_generation * 0.9), 99)
-        else:
-            constant_max_power = 800
-
-    if total_power_generation is None:
-        total_power_generation = 0
-
-    max_power = constant_max_power
-
-    if car_charging > 10:
-        max_power = int(total_power_generation * 0.9)
-
-    if soc is not None and soc <= 17:
-        max_power = int(total_power_generation * 0.9)
-
-    if soc is not None and soc <= 85:
-        min_power = 0
-    else: # "battery full" case
-        # This is kind of a work-around for bugs in PowerStream firmware, which
-        # sometimes behaves strange if it hits real bat max SoC. Sometimes it
-        # does not inject all generation. We try to avoid this by taking action
-        # before real max Soc.
-        min_power = int(total_power_generation * 0.98)
-
-    print(f"min/max power ({min_power},{max_power}), SoC: {soc}, PV: {total_power_generation}, car {car_charging}, pwr_in {current_power}")
+        logging.error("Failed to update SoC of %s: %s", device.sn, e)
+    device.telemetry.publish(time.time(), soc=None, pv1_power=None, pv2_power=None)
+
+async def query_devices(ecoflow_api, mqtt_client, targets):
+    # quota polls of all devices run concurrently in the executor, so the
+    # round trip does not grow with the number of devices
+    loop = asyncio.get_running_loop()
+    # keep the device status cache warm so setpoint writes don't have to;
+    # one list query covers all devices
+    if not all(ecoflow_api.device_status_is_fresh(device.sn) for device in targets):
+        try:
+            await loop.run_in_executor(None, ecoflow_api.refresh_device_status)
+        except Exception as e:
+            logging.error("Failed to refresh device status: %s", e)
+    await asyncio.gather(*(loop.run_in_executor(None, update_and_get_soc, ecoflow_api, mqtt_client, device)
+                           for device in targets))
+
+async def poll_devices(ecoflow_api, mqtt_client, targets=None):
+    targets = list(devices.values()) if targets is None else targets
+    deadline = config_handler.get('poll_deadline', DEFAULT_POLL_DEADLINE)
+    try:
+        # queries still running after the deadline finish in their threads,
+        # the caller no longer waits for them
+        await asyncio.wait_for(query_devices(ecoflow_api, mqtt_client, targets), deadline)
+    except asyncio.TimeoutError:
+        metrics.inc('deadline_exceeded', stage='device_poll')
+        logging.error("EcoFlow poll did not finish within %ss", deadline)
+    update_site_totals()
+    publish_soc_pv(mqtt_client)
+
+def get_inject_power_range(snapshot):
+    # the policy describes one PowerStream, so it is evaluated per device with
+    # that device's SoC, PV and latch; the site range is the sum
+    hour = datetime.now().hour
+    min_power = max_power = 0
+    for device in devices.values():
+        telemetry = device.telemetry.snapshot()
+        latched = device.soc_below_30
+        device_min, device_max, device.soc_below_30 = inject_policy.evaluate(
+            hour, telemetry.soc, telemetry.total_power_generation, snapshot.car_charging, device.soc_below_30)
+        if device.soc_below_30 != latched:
+            mark_state_dirty()
+        device.set_limits(device_min, device_max)
+        min_power += device.min_limit
+        max_power += device.max_limit
+
+    # every decision: structured fields, and rate limited by log_pipeline
+    logging.info("Power range", extra={'min_power': min_power, 'max_power': max_power, 'soc': snapshot.soc,
+                                       'pv': snapshot.total_power_generation or 0,
+                                       'car': snapshot.car_charging, 'power_in': snapshot.current_power})
     return min_power, max_power
 
-def set_battery_output(current_power, config, ecoflow_api, mqtt_client):
+def set_battery_output(snapshot, config, ecoflow_api, mqtt_client):
+    # decides on one consistent snapshot of the site state
     global last_injection_value
 
-    min_power, max_power = get_inject_power_range()
+    with metrics.timed('limit_computation'):
+        min_power, max_power = get_inject_power_range(snapshot)
     #logging.info(f"got inject power range {min_power}, {max_power}")
-    injection_value = max(min(current_power + last_injection_value, max_power), 0)
-    eps = config.get('eps')
-
-    if current_power < -eps:
-        new_injection_value = max(last_injection_value + current_power, 0)
-        if last_injection_value > 0:
-            injection_value = new_injection_value
-            logging.info(f"Adjusting injection to {injection_value} watts due to negative power consumption.")
-        #else:
-            #logging.info("Current power is negative and injection is already 0. No change needed.")
-    elif current_power > eps:
-        if injection_value != last_injection_value:
-            logging.info(f"Increasing injection to {injection_value} watts due to positive power consumption.")
-            #else case
-            #logging.info("No significant change in power consumption. No change needed.")
-    #else:
-        #logging.info(f"Power consumption within epsilon range ({current_power}). No change needed.")
-        #return last_injection_value
+    # the meter reading reflects what the inverters were actually told, which
+    # lags behind the requested values while writes are pending
+    base_value = last_injection_value
+    outputs = [device.output() for device in devices.values()]
+    if any(output is not None for output in outputs):
+        base_value = sum(output or 0 for output in outputs)
+    pv = snapshot.total_power_generation if snapshot.total_power_generation is not None else 0
+    injection_value = controller.update(snapshot.current_power, base_value, min_power, max_power, pv, time.time())
 
     #if injection_value < min_power: # battery full case
     #    injection_value = min_power
 
-    if injection_value != last_injection_value:
-        ecoflow_api.set_ef_powerstream_custom_load_power(injection_value)
-        logging.info(f"Setting battery output to {injection_value} watts")
+    shares = allocate(injection_value, devices.values())
+    changed = False
+    for device in devices.values():
+        if shares[device.sn] != device.scheduler.requested:
+            device.scheduler.request(shares[device.sn])
+            changed = True
+    if changed:
+        if len(devices) > 1:
+            logging.info("Setting battery output to %s watts, split %s", injection_value, shares)
+        else:
+            logging.info("Setting battery output to %s watts", injection_value)
     
     # Publish power injection to MQTT
     payload = {"pwr_injection": injection_value}
     publish_to_mqtt(mqtt_client, 'rg_PwrMgmt-to-HA', payload)
 
+    if recorder is not None:
+        recorder.record(snapshot.current_power, injection_value, min_power, max_power,
+                        snapshot.soc, snapshot.pv1_power, snapshot.pv2_power)
+
     last_injection_value = injection_value
 
     return
 
-def get_power_in(mqtt_client):
-    global current_power, last_power_in_check_time, config_handler
-    try:
-        url = config_handler.get('url')
-        response = requests.get(url)
-        response.raise_for_status()
-        data = response.json()
-        if 'StatusSNS' in data and 'E320' in data['StatusSNS'] and 'Power_in' in data['StatusSNS']['E320']:
-            power_in = int(data['StatusSNS']['E320']['Power_in'])
-            current_power = power_in
-            # Publish power consumption to MQTT
-            payload = {"SmartMeter_currentPowerIn": int(power_in)}
-            publish_to_mqtt(mqtt_client, 'rg_PwrMgmt-to-HA', payload)
-            last_power_in_check_time = time.time()
-            return power_in
-        else:
-            raise ValueError("Required data not found in the response")
-    except requests.RequestException as e:
-        raise RuntimeError(f"HTTP request failed: {e}")
-    except ValueError as e:
-        raise RuntimeError(f"Data extraction error: {e}")
+def write_setpoint(ecoflow_api, value, sn=None):
+    return command_succeeded(ecoflow_api.set_ef_powerstream_custom_load_power(value, sn))
+
+def on_setpoint_confirmed(value):
+    # HA sees the site total; devices without a confirmed write count as 0
+    confirmed = sum(device.scheduler.confirmed or 0 for device in devices.values())
+    publish_to_mqtt(mqtt_client, 'rg_PwrMgmt-to-HA', {"pwr_injection_confirmed": confirmed})
+    mark_state_dirty()
+
+def collect_state():
+    # what a restart needs to continue where it stopped, see restore_state()
+    snapshot = site.snapshot()
+    state = {
+        'time': time.time(),
+        'site': {field: [getattr(snapshot, field), getattr(snapshot, f"{field}_time")]
+                 for field in ('injection_permitted', 'car_charging')},
+        'devices': {},
+    }
+    for device in devices.values():
+        telemetry = device.telemetry.snapshot()
+        stamps = telemetry.stamps()
+        state['devices'][device.sn] = {
+            'setpoint': device.scheduler.confirmed,
+            'soc_below_30': device.soc_below_30,
+            'telemetry': {field: [value, stamps[field]] for field, value in telemetry.as_dict().items()},
+        }
+    return state
+
+def restore_state(data, max_age):
+    # readings keep their original timestamps, so the usual staleness checks
+    # decide whether they are still good enough; setpoint and latch are only
+    # taken over if the state is recent. permanent_watts is left out: only
+    # the device itself may report it, see adopt_reported_setpoints()
+    age = time.time() - data.get('time', 0)
+    for field, (value, stamp) in data.get('site', {}).items():
+        site.publish(stamp, **{field: value})
+    for sn, saved in data.get('devices', {}).items():
+        device = devices.get(sn)
+        if device is None:
+            continue
+        for field, (value, stamp) in saved.get('telemetry', {}).items():
+            if field not in ('total_power_generation', 'permanent_watts') and value is not None:
+                device.telemetry.publish(stamp, **{field: value})
+        if age < max_age:
+            device.soc_below_30 = saved.get('soc_below_30', False)
+            if saved.get('setpoint') is not None:
+                device.scheduler.assume(saved['setpoint'])
+    update_site_totals()
+    sync_injection_value()
+    logging.info("Restored state from %ss ago, setpoints %s", int(age), [device.output() for device in devices.values()])
+
+def adopt_reported_setpoints():
+    # the setpoint the device reports beats anything remembered: no write is
+    # needed to find out where the inverter stands
+    for device in devices.values():
+        reported = device.telemetry.snapshot().permanent_watts
+        if reported is not None and device.scheduler.settled():
+            device.scheduler.assume(int(reported))
+    return sync_injection_value()
+
+def sync_injection_value():
+    # the site total the controller starts from is what the devices run at;
+    # returns True once that is known for every device
+    global last_injection_value
+    outputs = [device.output() for device in devices.values() if device.output() is not None]
+    if outputs:
+        last_injection_value = sum(outputs)
+    return len(outputs) == len(devices)
 
-def power_in_loop(url, mqtt_client, config_handler):
+async def state_save_loop(path, interval):
+    loop = asyncio.get_running_loop()
     while True:
-        get_power_in(mqtt_client)
-        time.sleep(config_handler.get('sleep_time'))
-
-def processing_loop(url, config_handler, ecoflow_api, mqtt_client):
-    global last_injection_value, last_soc_check_time, current_power
-    last_injection_value = 1  # Initialize the last injection value
-    last_soc_check_time = time.time()
+        try:
+            await asyncio.wait_for(state_dirty.wait(), interval)
+        except asyncio.TimeoutError:
+            pass
+        state_dirty.clear()
+        try:
+            await loop.run_in_executor(None, save_json_atomic, path, collect_state())
+        except OSError as e:
+            logging.error("Failed to save state to %s: %s", path, e)
+
+def process_power_in(power_in, mqtt_client):
+    site.publish(time.time(), current_power=power_in)
+    # Publish power consumption to MQTT
+    payload = {"SmartMeter_currentPowerIn": int(power_in)}
+    if meter is not None and len(meter.sources) > 1:
+        for source in meter.sources:
+            if source.value is not None:
+                payload[f"SmartMeter_{source.name}"] = int(source.value)
+    publish_to_mqtt(mqtt_client, 'rg_PwrMgmt-to-HA', payload)
 
+async def get_power_in(mqtt_client, force=False):
+    # reads the meter sources concurrently and combines them into the net
+    # power; force polls every HTTP source, even those with a live stream
+    attempted, succeeded = await meter.poll(time.time(), force)
+    if attempted and not succeeded:
+        raise RuntimeError("no meter source could be read")
+    power_in = meter.net_power(time.time())
+    if power_in is None:
+        raise RuntimeError("no fresh meter reading")
+    process_power_in(power_in, mqtt_client)
+    return power_in
+
+def site_is_idle():
+    # the meter cannot move the setpoint: every device sits at its upper
+    # limit while the site still imports (e.g. the night cap), or at its
+    # lower limit while it exports
+    power_in = site.snapshot().current_power
+    margin = meter_poller.fast_change
+    at_max = all(device.output() == device.max_limit for device in devices.values())
+    at_min = all(device.output() == device.min_limit for device in devices.values())
+    return (at_max and power_in > margin) or (at_min and power_in < -margin)
+
+async def wait_for_poll(poller, beat):
+    # the idle interval or a used up call budget may stretch the wait beyond
+    # the ceiling; sleeping in slices of at most the ceiling keeps the
+    # heartbeat going meanwhile
+    loop = asyncio.get_running_loop()
+    until = loop.time() + poller.delay(loop.time())
+    while until - loop.time() > poller.ceiling:
+        await asyncio.sleep(poller.ceiling)
+        beat()
+    await asyncio.sleep(max(until - loop.time(), 0))
+
+async def power_in_loop(mqtt_client, beat):
+    loop = asyncio.get_running_loop()
+    idle = False
+    while True:
+        beat()
+        # with push-mode metering HTTP is only the fallback for stale streams
+        if meter.needs_poll(time.time()):
+            meter_poller.spend(loop.time())
+            try:
+                power_in = await get_power_in(mqtt_client)
+                meter_poller.observe(power_in)
+                events.put_nowait(('power_in', power_in))
+            except RuntimeError as e:
+                logging.error("get_power_in failed: %s", e)
+        if site_is_idle():
+            meter_poller.idle()
+        elif idle:
+            meter_poller.hurry()
+        idle = site_is_idle()
+        await wait_for_poll(meter_poller, beat)
+
+async def soc_loop(ecoflow_api, mqtt_client, beat):
+    loop = asyncio.get_running_loop()
+    while True:
+        beat()
+        await wait_for_poll(cloud_poller, beat)
+        # the EcoFlow MQTT quota stream is the primary source, REST polling
+        # only fills in for the devices it is silent about; a REST answer
+        # must not count as the stream, or the fallback would only run
+        # every telemetry_stale_after seconds
+        stale = list(devices.values())
+        if ecoflow_api.mqtt_connected:
+            stale_after = max(config_handler.get('telemetry_stale_after', DEFAULT_TELEMETRY_STALE_AFTER),
+                              cloud_poller.interval)
+            stale = [device for device in stale if device.stream_age(time.time()) >= stale_after]
+        if not stale:
+            continue
+        cloud_poller.spend(loop.time(), len(stale))
+        await poll_devices(ecoflow_api, mqtt_client, stale)
+        events.put_nowait(('telemetry', None))
+        # fast while PV moves or a battery nears a policy threshold, slow at night
+        snapshot = site.snapshot()
+        cloud_poller.observe(snapshot.total_power_generation)
+        if not snapshot.total_power_generation:
+            cloud_poller.idle()
+        margin = config_handler.get('soc_threshold_margin', SOC_THRESHOLD_MARGIN)
+        if any(inject_policy.near_soc_threshold(device.telemetry.snapshot().soc, margin) for device in devices.values()):
+            cloud_poller.hurry()
+
+async def metrics_summary_loop(mqtt_client, interval):
+    while True:
+        await asyncio.sleep(interval)
+        mqtt_client.publish('rg_PwrMgmt-metrics', json.dumps(metrics.registry.summary()))
+
+async def processing_loop(config_handler, ecoflow_api, mqtt_client, beat):
+    # runs under the supervisor: an exception restarts it from here, and the
+    # warm start below picks up the setpoints the devices already run at
+    loop = asyncio.get_running_loop()
+    beat()
+    # SoC/PV (including the setpoint the devices report) and the meter are
+    # independent: the cloud poll runs in the background, and the first
+    # decision is made once there is a meter reading and the setpoints are
+    # known - restored, streamed or, failing both, reported by the poll
+    boot_poll = asyncio.ensure_future(poll_devices(ecoflow_api, mqtt_client))
+    boot_poll.add_done_callback(lambda task: events.put_nowait(('telemetry', None)))
     try:
-        # Get initial SoC immediately after startup
-        update_and_get_soc(ecoflow_api, mqtt_client)
-
-        # Initial setting to establish the state of the battery subsystem
-        current_power = get_power_in(mqtt_client)
-        logging.info(f"Initial Power_in: {current_power} watts, Current Injection: {last_injection_value} watts")
-        set_battery_output(current_power, config_handler, ecoflow_api, mqtt_client)
-        logging.info(f"Initial setting done. Sleeping for {config_handler.get('min_change_interval')} seconds.")
-        time.sleep(config_handler.get('min_change_interval'))
-
-        while True:
-            mqtt_client.loop()  # Process MQTT messages
-
-            current_time = time.time()
-            if current_time - last_soc_check_time >= 20:  # Update SoC every 60 seconds
-                update_and_get_soc(ecoflow_api, mqtt_client)
-                last_soc_check_time = current_time
-            # saveguard for now - we had stalled process
-            if current_time - last_power_in_check_time >= 10:
-                logging.error(f"ERROR: get_power_in stalled for {int(current_time - last_power_in_check_time)} seconds - polling it now!")
-                get_power_in(mqtt_client)
-
-            set_battery_output(current_power, config_handler, ecoflow_api, mqtt_client)
-            time.sleep(config_handler.get('hysteresis_interval') if last_injection_value != 0 else config_handler.get('sleep_time'))
-    except Exception as e:
-        logging.error("An exception occurred:")
-        traceback.print_exc()
+        current_power = await first_power_in(mqtt_client, beat)
+        warm = adopt_reported_setpoints()
+        if not warm and not boot_poll.done():
+            beat()
+            await boot_poll
+            warm = adopt_reported_setpoints()
+    except asyncio.CancelledError:
+        # restarted or shutting down before the first decision
+        boot_poll.cancel()
+        raise
+    logging.info("Initial Power_in: %s watts, Current Injection: %s watts", current_power, last_injection_value)
+    previous_injection_value = last_injection_value
+    set_battery_output(site.snapshot(), config_handler, ecoflow_api, mqtt_client)
+
+    # Hysteresis is a minimum time between two setpoint changes: every
+    # event is evaluated right away unless the last change is too recent,
+    # in which case the decision is deferred until the hold time expired.
+    # With the current setpoints known and nothing to change, control
+    # continues with the next reading instead of holding blind.
+    if warm and last_injection_value == previous_injection_value:
+        logging.info("Warm start, setpoints unchanged.")
+        next_write_time = loop.time()
+    else:
+        logging.info("Initial setting done. Holding output for %s seconds.", config_handler.get('min_change_interval'))
+        next_write_time = loop.time() + config_handler.get('min_change_interval')
+    pending = False
+    stalled = False
+    while True:
+        beat()
+        timeout = STALL_CHECK_INTERVAL
+        if pending:
+            timeout = min(timeout, max(next_write_time - loop.time(), 0))
+        try:
+            await asyncio.wait_for(events.get(), timeout)
+            # coalesce everything that queued up meanwhile into one decision
+            while not events.empty():
+                events.get_nowait()
+            pending = True
+        except asyncio.TimeoutError:
+            pass
+
+        # a reading older than the longest a healthy meter takes at the
+        # current poll interval is a stall; while the meter's call budget is
+        # used up, old readings are expected
+        reading_age = site.snapshot().age('current_power', time.time())
+        if reading_age >= meter.reading_deadline(meter_poller.interval) and not meter_poller.throttled:
+            if not stalled:
+                stalled = True
+                metrics.inc('meter_stalls')
+                logging.error("ERROR: get_power_in stalled for %.1f seconds - polling it now!", reading_age)
+            try:
+                await get_power_in(mqtt_client, force=True)
+                pending = True
+            except RuntimeError as e:
+                logging.error("get_power_in failed: %s", e)
+        elif stalled:
+            stalled = False
+            logging.info("Meter readings are current again")
+
+        if pending and loop.time() >= next_write_time:
+            pending = False
+            previous_injection_value = last_injection_value
+            # only hands the target to the scheduler, the PUT happens there
+            set_battery_output(site.snapshot(), config_handler, ecoflow_api, mqtt_client)
+            if last_injection_value != previous_injection_value:
+                hold = config_handler.get('hysteresis_interval') if last_injection_value != 0 else config_handler.get('sleep_time')
+                next_write_time = loop.time() + hold
+
+async def first_power_in(mqtt_client, beat):
+    # a meter that cannot be read at startup is retried here rather than
+    # failing the worker into the supervisor's restart backoff
+    while True:
+        beat()
+        try:
+            return await get_power_in(mqtt_client, force=True)
+        except RuntimeError as e:
+            logging.error("Initial get_power_in failed: %s", e)
+        await asyncio.sleep(meter_poller.floor)
+
+async def connect_ecoflow_mqtt(ecoflow_api, client_id):
+    # failures are retried by the supervisor, REST polling covers meanwhile
+    await asyncio.get_running_loop().run_in_executor(None, ecoflow_api.connect_to_mqtt, client_id)
+
+async def run_controller(config_handler, ecoflow_api, mqtt_client):
+    global event_loop, events, devices, controller, inject_policy, state_dirty, meter_poller, cloud_poller
+    event_loop = asyncio.get_running_loop()
+    events = asyncio.Queue()
+    controller = create_controller(config_handler)
+    inject_policy = InjectPolicy.from_config(config_handler)
+    unknown = set(ecoflow_api.quota_keys.values()) - set(DeviceTelemetry.FIELDS)
+    if unknown:
+        raise ValueError(f"quota_keys: unknown fields {sorted(unknown)}, use one of {DeviceTelemetry.FIELDS}")
+    devices = {}
+    for sn in ecoflow_api.serial_numbers:
+        device = PowerStream.from_config(sn, config_handler)
+        # one scheduler per device, so writes to different devices run in parallel
+        device.scheduler = SetpointScheduler.from_config(
+            lambda value, sn=sn: write_setpoint(ecoflow_api, value, sn), config_handler, on_setpoint_confirmed)
+        devices[sn] = device
+
+    sleep_time = config_handler.get('sleep_time')
+    meter_poller = AdaptivePoller.from_config('meter', config_handler, min(METER_POLL_FLOOR, sleep_time), sleep_time,
+                                              2 * config_handler.get('eps'), METER_POLL_IDLE)
+    cloud_poller = AdaptivePoller.from_config('cloud', config_handler, SOC_POLL_INTERVAL, SOC_POLL_CEILING,
+                                              PV_FAST_CHANGE)
+
+    state_file = config_handler.get('state_file')
+    if state_file:
+        state_dirty = asyncio.Event()
+        saved = load_json(state_file)
+        if saved:
+            restore_state(saved, config_handler.get('state_max_age', DEFAULT_STATE_MAX_AGE))
+
+    # every worker runs under the supervisor; the heartbeat timeouts are the
+    # longest regular iteration of each loop plus a margin
+    poll_deadline = config_handler.get('poll_deadline', DEFAULT_POLL_DEADLINE)
+    supervisor = Supervisor.from_config(config_handler)
+    supervisor.add('processing', lambda beat: processing_loop(config_handler, ecoflow_api, mqtt_client, beat),
+                   heartbeat_timeout=poll_deadline + HEARTBEAT_MARGIN)
+    supervisor.add('power_in', lambda beat: power_in_loop(mqtt_client, beat),
+                   heartbeat_timeout=meter.reading_deadline(meter_poller.ceiling) + HEARTBEAT_MARGIN)
+    supervisor.add('soc', lambda beat: soc_loop(ecoflow_api, mqtt_client, beat),
+                   heartbeat_timeout=cloud_poller.ceiling + poll_deadline + HEARTBEAT_MARGIN)
+    # EcoFlow cloud MQTT delivers SoC/PV as they change, REST is the fallback;
+    # connected only now that the devices exist to receive it, alongside the
+    # initial queries
+    if config_handler.get('ecoflow_mqtt', True):
+        client_id = config_handler.get('ECOFLOW_MQTT_CLIENT_ID', 'rg_pwrMgmt')
+        supervisor.add('ecoflow_mqtt', lambda beat: connect_ecoflow_mqtt(ecoflow_api, client_id))
+    if state_file:
+        save_interval = config_handler.get('state_save_interval', DEFAULT_STATE_SAVE_INTERVAL)
+        supervisor.add('state_save', lambda beat: state_save_loop(state_file, save_interval))
+    for device in devices.values():
+        supervisor.add(f"scheduler {device.sn}", lambda beat, device=device: device.scheduler.run())
+    if config_handler.get('metrics_mqtt_interval'):
+        metrics_interval = config_handler.get('metrics_mqtt_interval')
+        supervisor.add('metrics', lambda beat: metrics_summary_loop(mqtt_client, metrics_interval))
+
+    # paho handles the HA broker connection in its own network thread
+    mqtt_client.loop_start()
+    try:
+        await supervisor.run()
+    finally:
+        mqtt_client.loop_stop()
+        if state_file:
+            try:
+                save_json_atomic(state_file, collect_state())
+            except OSError as e:
+                logging.error("Failed to save state to %s: %s", state_file, e)
 
 def main():
-    global mqtt_client, config_handler
+    global mqtt_client, config_handler, http_transport, meter, state_publisher, recorder
     logging.info("EcoFlow PowerStream Management Script")
     config_handler = ConfigHandler()
+    log_listener = setup_logging(config_handler)
+    http_transport = HttpTransport.from_config(config_handler)
+    meter = MeterAggregator.from_config(config_handler, http_transport)
+
+    if config_handler.get('metrics_port'):
+        metrics.start_http_server(config_handler.get('metrics_port'), config_handler.get('metrics_address', '127.0.0.1'))
 
     mqtt_client = setup_mqtt_client(config_handler)
+    state_publisher = StatePublisher.from_config(mqtt_client, config_handler)
+    state_publisher.start()
+
+    if config_handler.get('recorder_dir'):
+        recorder = TelemetryRecorder.from_config(config_handler)
+        recorder.start()
     
     ecoflow_api = EcoFlowAPI(
         config_handler.get('ECOFLOW_API_HTTP_URL'), 
         config_handler.get('ECOFLOW_ACCESSKEY'), 
         config_handler.get('ECOFLOW_SECRETKEY'), 
         config_handler.get('ECOFLOW_SN'),
-        on_status_update
+        on_status_update,
+        http_transport,
+        config_handler.get('device_status_ttl', DEFAULT_DEVICE_STATUS_TTL),
+        config_handler.get('quota_keys'),
+        config_handler.get('ecoflow_mqtt_commands', False),
+        config_handler.get('mqtt_command_timeout', DEFAULT_MQTT_COMMAND_TIMEOUT),
+        CircuitBreaker.from_config('EcoFlow REST', config_handler)
     )
 
-    url = config_handler.get('url')
-    
-    # Connect to MQTT server
-    # mqtt API does NOT work right now - unknown reason
-    #ecoflow_api.connect_to_mqtt()
-
-    # initial queries
-    update_and_get_soc(ecoflow_api, mqtt_client)
-    get_power_in(mqtt_client)
-
-    # Start the power_in_loop in a separate thread
-    power_in_thread = threading.Thread(target=power_in_loop, args=(url, mqtt_client, config_handler))
-    power_in_thread.daemon = True
-    power_in_thread.start()
-
-    processing_loop(url, config_handler, ecoflow_api, mqtt_client)
+    try:
+        asyncio.run(run_controller(config_handler, ecoflow_api, mqtt_client))
+    finally:
+        # flushes what is still queued
+        log_listener.stop()
 
 if __name__ == "__main__":
     main()
-
@@ -0,0 +1,93 @@
+import asyncio
+import logging
+
+import metrics
+
+DEFAULT_RETRY_BACKOFF = 1
+DEFAULT_MAX_BACKOFF = 60
+
+class SetpointScheduler:
+    # Owns the PowerStream setpoint. The controller only calls request(),
+    # which never blocks; a single writer task sends the most recent target
+    # (bursts collapse to the latest value), spaced by min_interval, limited
+    # to max_step watts per write and retried with exponential backoff.
+    def __init__(self, write, min_interval, max_step=None, retry_backoff=DEFAULT_RETRY_BACKOFF,
+                 max_backoff=DEFAULT_MAX_BACKOFF, on_confirm=None):
+        self.write = write  # blocking callable(value) -> True on success
+        self.min_interval = min_interval
+        self.max_step = max_step
+        self.retry_backoff = retry_backoff
+        self.max_backoff = max_backoff
+        self.on_confirm = on_confirm
+        self.requested = None
+        self.confirmed = None
+        self.in_flight = None
+        self.failures = 0
+        self.last_write_time = None
+        self.wakeup = asyncio.Event()
+
+    @classmethod
+    def from_config(cls, write, config, on_confirm=None):
+        return cls(
+            write,
+            config.get('min_change_interval'),
+            max_step=config.get('max_step'),
+            retry_backoff=config.get('write_retry_backoff', DEFAULT_RETRY_BACKOFF),
+            max_backoff=config.get('write_max_backoff', DEFAULT_MAX_BACKOFF),
+            on_confirm=on_confirm
+        )
+
+    def request(self, value):
+        # must be called from the event loop thread
+        if not self.settled() and self.requested != self.in_flight:
+            # the previous target was never sent
+            metrics.inc('setpoint_writes_coalesced')
+        self.requested = value
+        self.wakeup.set()
+
+    def assume(self, value):
+        # the device already runs at value (restored or reported by it), so
+        # there is nothing to write
+        self.requested = self.confirmed = value
+
+    def settled(self):
+        return self.requested is None or self.requested == self.confirmed
+
+    def next_value(self):
+        if self.max_step is None or self.confirmed is None:
+            return self.requested
+        step = max(min(self.requested - self.confirmed, self.max_step), -self.max_step)
+        return self.confirmed + step
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            while not self.settled():
+                if self.last_write_time is not None:
+                    delay = self.last_write_time + self.min_interval - loop.time()
+                    if delay > 0:
+                        # newer requests arriving meanwhile simply replace the target
+                        await asyncio.sleep(delay)
+                        continue
+                value = self.next_value()
+                self.in_flight = value
+                self.last_write_time = loop.time()
+                try:
+                    ok = await loop.run_in_executor(None, self.write, value)
+                except Exception as e:
+                    logging.error("Setpoint write of %s W failed: %s", value, e)
+                    ok = False
+                self.in_flight = None
+                if ok:
+                    self.failures = 0
+                    self.confirmed = value
+                    if self.on_confirm:
+                        self.on_confirm(value)
+                else:
+                    self.failures += 1
+                    metrics.inc('setpoint_retries')
+                    backoff = min(self.retry_backoff * 2 ** (self.failures - 1), self.max_backoff)
+                    logging.warning("Setpoint write of %s W not confirmed, retry %s in %ss", value, self.failures, backoff)
+                    await asyncio.sleep(backoff)
@@ -0,0 +1,534 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import logging
+import math
+import random
+import statistics
+import sys
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+from paho.mqtt.client import MQTTMessageInfo, topic_matches_sub
+
+import circuit_breaker
+import ecoflow_api
+import mqtt_publisher
+import pwrmgmt
+from http_transport import HttpTransport
+from meters import MeterAggregator
+from mqtt_publisher import StatePublisher
+from state import SiteState, StateStore
+
+# Offline replay/simulation harness. The real controller runtime
+# (pwrmgmt.run_controller) runs on an event loop with virtual time against
+# local stand-ins for the Tasmota meter, the EcoFlow REST API and the MQTT
+# broker, while a simple plant model closes the loop between setpoint,
+# household load, PV and battery.
+
+SIM_SN = 'SIMULATED0001'
+SIM_START = datetime(2026, 6, 1).timestamp()
+
+SIM_CONFIG = {
+    'hysteresis_interval': 10,
+    'sleep_time': 2,
+    'eps': 20,
+    'min_change_interval': 10,
+    'meter_source': 'http',
+    'ecoflow_mqtt': False,
+}
+
+class VirtualTimeLoop(asyncio.SelectorEventLoop):
+    # Time only moves when every task is waiting for a timer; it then jumps
+    # straight to the next one. Executor jobs run inline so nothing can
+    # happen "in the background" while virtual time stands still.
+    def __init__(self):
+        super().__init__()
+        self.virtual_time = 0.0
+
+    def time(self):
+        return self.virtual_time
+
+    def run_in_executor(self, executor, func, *args):
+        future = self.create_future()
+        try:
+            future.set_result(func(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def _run_once(self):
+        if not self._ready and self._scheduled:
+            self.virtual_time = max(self.virtual_time, self._scheduled[0].when())
+        super()._run_once()
+
+class SimClock:
+    # stands in for the time module inside the controller modules; the loop
+    # counts from zero like a monotonic clock, wall time is offset by start
+    def __init__(self, loop, start):
+        self.loop = loop
+        self.start = start
+
+    def time(self):
+        return self.start + self.loop.time()
+
+    def monotonic(self):
+        return self.loop.time()
+
+    def sleep(self, seconds):
+        raise RuntimeError("blocking sleep inside the simulated controller")
+
+def sim_datetime(clock):
+    class SimDatetime(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return datetime.fromtimestamp(clock.time(), tz)
+    return SimDatetime
+
+class Plant:
+    def __init__(self, clock, capacity_wh=2000, soc=50, inverter_delay=2, noise=0):
+        self.clock = clock
+        self.capacity_wh = capacity_wh
+        self.soc = soc
+        self.inverter_delay = inverter_delay
+        self.noise = noise
+        self.load = 0
+        self.pv = 0
+        self.output = 0
+        self.commands = []  # (effective_time, watts)
+        self.power_in = 0
+        self.lock = threading.Lock()
+
+    def set_output(self, watts):
+        with self.lock:
+            self.commands.append((self.clock.time() + self.inverter_delay, watts))
+
+    def advance(self, dt, load, pv):
+        now = self.clock.time()
+        with self.lock:
+            while self.commands and self.commands[0][0] <= now:
+                self.output = self.commands.pop(0)[1]
+        available = self.output if self.soc > 0 else min(self.output, pv)
+        self.soc += (pv - available) * dt / 3600 / self.capacity_wh * 100
+        self.soc = max(min(self.soc, 100), 0)
+        self.load = load
+        self.pv = pv
+        self.power_in = load - available
+        return self.power_in
+
+    def meter_reading(self):
+        return int(self.power_in + (random.gauss(0, self.noise) if self.noise else 0))
+
+class LocalMessage:
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+class LocalBroker:
+    # in-process stand-in for the MQTT broker, delivers synchronously
+    def __init__(self):
+        self.clients = []
+        self.published = {}
+
+    def client(self):
+        client = LocalClient(self)
+        self.clients.append(client)
+        return client
+
+    def publish(self, topic, payload, retain=False):
+        self.published[topic] = self.published.get(topic, 0) + 1
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        message = LocalMessage(topic, payload)
+        for client in self.clients:
+            client.deliver(message)
+
+class LocalClient:
+    def __init__(self, broker):
+        self.broker = broker
+        self.subscriptions = []
+        self.callbacks = {}
+        self.on_message = None
+
+    def subscribe(self, topic):
+        self.subscriptions.append(topic)
+
+    def message_callback_add(self, topic, callback):
+        self.callbacks[topic] = callback
+        self.subscriptions.append(topic)
+
+    def publish(self, topic, payload, retain=False):
+        self.broker.publish(topic, payload, retain)
+        return MQTTMessageInfo(0)
+
+    def deliver(self, message):
+        for topic, callback in self.callbacks.items():
+            if topic_matches_sub(topic, message.topic):
+                callback(self, None, message)
+                return
+        if self.on_message and any(topic_matches_sub(sub, message.topic) for sub in self.subscriptions):
+            self.on_message(self, None, message)
+
+    def loop_start(self):
+        pass
+
+    def loop_stop(self):
+        pass
+
+class StandInServer:
+    def __init__(self, handler):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+def tasmota_handler(plant, counters):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # headers and body go out in separate writes; without this every
+        # keep-alive request waits for a delayed ACK
+        disable_nagle_algorithm = True
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            counters['tasmota'] = counters.get('tasmota', 0) + 1
+            self.reply({"StatusSNS": {"E320": {"Power_in": plant.meter_reading()}}})
+
+        def reply(self, data):
+            body = json.dumps(data).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+    return Handler
+
+def ecoflow_handler(plant, counters):
+    class Handler(tasmota_handler(plant, counters)):
+        def count(self, endpoint=None):
+            endpoint = endpoint or urlsplit(self.path).path.rsplit('/', 1)[-1]
+            counters[endpoint] = counters.get(endpoint, 0) + 1
+            return endpoint
+
+        def read_body(self):
+            length = int(self.headers.get('Content-Length', 0))
+            return json.loads(self.rfile.read(length)) if length else {}
+
+        def quota(self, keys=None):
+            pv = plant.pv * 10
+            data = {'20_1.batSoc': int(plant.soc), '20_1.pv1InputWatts': pv / 2, '20_1.pv2InputWatts': pv / 2,
+                    '20_1.permanentWatts': plant.output * 10}
+            if keys:
+                data = {key: data[key] for key in keys if key in data}
+            return {"code": "0", "data": data}
+
+        def do_GET(self):
+            endpoint = self.count()
+            self.read_body()
+            if endpoint == 'list':
+                self.reply({"code": "0", "data": [{"sn": SIM_SN, "online": 1}]})
+            elif endpoint == 'all':
+                self.reply(self.quota())
+            elif endpoint == 'certification':
+                self.reply({"code": "0", "data": {"url": "127.0.0.1", "port": "8883",
+                                                  "certificateAccount": "sim", "certificatePassword": "sim"}})
+            else:
+                self.reply({"code": "404"})
+
+        def do_POST(self):
+            # selective quota query, same path as the setpoint PUT
+            self.count('quota_query')
+            body = self.read_body()
+            self.reply(self.quota(body.get('params', {}).get('quotas')))
+
+        def do_PUT(self):
+            self.count()
+            body = self.read_body()
+            plant.set_output(body['params']['permanentWatts'] / 10)
+            self.reply({"code": "0"})
+    return Handler
+
+# traces are lists of (load_w, pv_w, car_charging) at one second resolution
+
+def steps_trace(seconds=3600, base=250, step=450, pv=600):
+    trace = []
+    for t in range(seconds):
+        # appliance style steps: 3 minutes on, 7 minutes off
+        load = base + (step if t % 600 >= 420 else 0)
+        trace.append((load, pv, 0))
+    return trace
+
+def noisy_trace(seconds=3600, base=300, pv=500, seed=1):
+    rng = random.Random(seed)
+    trace = []
+    for t in range(seconds):
+        fridge = 120 if (t // 900) % 2 else 0
+        spike = 1500 if rng.random() < 0.002 else 0
+        trace.append((base + fridge + spike + rng.gauss(0, 25), pv, 0))
+    return trace
+
+def day_trace(seconds=86400, peak_pv=700, seed=2):
+    rng = random.Random(seed)
+    trace = []
+    load = 250
+    car = 0
+    for t in range(seconds):
+        hour = t / 3600
+        pv = max(math.sin((hour - 6) / 14 * math.pi), 0) * peak_pv
+        if rng.random() < 0.001:
+            load = rng.choice([180, 250, 400, 900, 2200])
+        car = 1500 if 17 <= hour < 19 else 0
+        trace.append((load, pv, car))
+    return trace
+
+def recorded_trace(directory, start=None, end=None):
+    # the recorder stores net meter power and the setpoint; the household
+    # load is approximately their sum
+    from telemetry_recorder import iter_records
+    trace = []
+    first_time = last_time = None
+    for timestamp, power_in, setpoint, _, _, soc, pv1, pv2 in iter_records(directory, start, end):
+        pv = (0 if math.isnan(pv1) else pv1) + (0 if math.isnan(pv2) else pv2)
+        row = (power_in + (0 if math.isnan(setpoint) else setpoint), pv, 0)
+        steps = 1 if last_time is None else max(int(round(timestamp - last_time)), 1)
+        trace.extend([row] * steps)
+        if first_time is None:
+            first_time = timestamp
+        last_time = timestamp
+    return first_time or SIM_START, trace
+
+# name -> (trace generator, start offset from SIM_START in seconds)
+SCENARIOS = {
+    'steps': (steps_trace, 10 * 3600),
+    'noisy': (noisy_trace, 10 * 3600),
+    'day': (day_trace, 0),
+}
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values) * pct / 100), len(values) - 1)]
+
+class Results:
+    def __init__(self, settle_band, step_threshold):
+        self.settle_band = settle_band
+        self.step_threshold = step_threshold
+        self.import_wh = 0
+        self.export_wh = 0
+        self.settle_times = []
+        self.unsettled = 0
+        self.step_time = None
+        self.last_load = None
+        self.reaction_latencies = []
+        self.decision_costs = []
+        self.reading_time = None
+
+    def sample(self, now, dt, load, power_in):
+        self.import_wh += max(power_in, 0) * dt / 3600
+        self.export_wh += max(-power_in, 0) * dt / 3600
+        if self.last_load is not None and abs(load - self.last_load) >= self.step_threshold:
+            if self.step_time is not None:
+                self.unsettled += 1
+            self.step_time = now
+        self.last_load = load
+        if self.step_time is not None and abs(power_in) <= self.settle_band:
+            self.settle_times.append(now - self.step_time)
+            self.step_time = None
+
+    def finish(self):
+        if self.step_time is not None:
+            self.unsettled += 1
+
+def instrument(results, clock):
+    # wrap the controller entry points to measure reaction latency (virtual
+    # seconds from a meter reading to the decision using it) and the
+    # wall-clock cost of each decision
+    process_power_in = pwrmgmt.process_power_in
+    set_battery_output = pwrmgmt.set_battery_output
+
+    def timed_process_power_in(*args):
+        if results.reading_time is None:
+            results.reading_time = clock.time()
+        return process_power_in(*args)
+
+    def timed_set_battery_output(*args):
+        start = time.perf_counter()
+        set_battery_output(*args)
+        results.decision_costs.append(time.perf_counter() - start)
+        if results.reading_time is not None:
+            results.reaction_latencies.append(clock.time() - results.reading_time)
+            results.reading_time = None
+
+    pwrmgmt.process_power_in = timed_process_power_in
+    pwrmgmt.set_battery_output = timed_set_battery_output
+    return process_power_in, set_battery_output
+
+def reset_controller_state():
+    pwrmgmt.last_injection_value = 1
+    pwrmgmt.site = StateStore(SiteState)
+    pwrmgmt.devices = {}
+    pwrmgmt.meter = None
+    pwrmgmt.event_loop = None
+    pwrmgmt.state_publisher = None
+    pwrmgmt.recorder = None
+    pwrmgmt.state_dirty = None
+    pwrmgmt.meter_poller = pwrmgmt.cloud_poller = None
+
+async def pump_publisher(publisher):
+    # the StatePublisher worker loop in virtual time: sends what is due,
+    # then sleeps until the next topic's rate limit expires
+    while True:
+        with publisher.condition:
+            due, wait = publisher.take_due()
+        for topic, fields in due.items():
+            publisher.send(topic, fields)
+        await asyncio.sleep(wait if wait is not None else publisher.min_interval)
+
+async def drive(plant, trace, broker, results, controller):
+    loop = asyncio.get_running_loop()
+    last_car = None
+    for load, pv, car in trace:
+        if car != last_car:
+            broker.publish("HA-to-rg_PwrMgmt", json.dumps({"injection_permitted": True, "car_charging": car}))
+            last_car = car
+        power_in = plant.advance(1, load, pv)
+        results.sample(loop.time(), 1, load, power_in)
+        if controller.done():
+            break
+        await asyncio.sleep(1)
+    controller.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+        await controller
+
+def run_scenario(name, trace, config, start=SIM_START, soc=50, noise=0):
+    loop = VirtualTimeLoop()
+    clock = SimClock(loop, start)
+    plant = Plant(clock, soc=soc, noise=noise)
+    broker = LocalBroker()
+    counters = {}
+    results = Results(settle_band=max(config.get('eps', 20) * 2, 50), step_threshold=300)
+    saved = (pwrmgmt.time, pwrmgmt.datetime, ecoflow_api.time, circuit_breaker.time, mqtt_publisher.time)
+    originals = instrument(results, clock)
+    try:
+        pwrmgmt.time = ecoflow_api.time = circuit_breaker.time = mqtt_publisher.time = clock
+        pwrmgmt.datetime = sim_datetime(clock)
+        with StandInServer(tasmota_handler(plant, counters)) as tasmota, \
+                StandInServer(ecoflow_handler(plant, counters)) as cloud:
+            sim_config = SimConfig(config, url=tasmota.url + 'cm?cmnd=status%208', state_file=None)
+            reset_controller_state()
+            pwrmgmt.config_handler = sim_config
+            pwrmgmt.http_transport = HttpTransport.from_config(sim_config)
+            pwrmgmt.meter = MeterAggregator.from_config(sim_config, pwrmgmt.http_transport)
+            client = broker.client()
+            client.on_message = pwrmgmt.on_message
+            client.subscribe("HA-to-rg_PwrMgmt")
+            pwrmgmt.mqtt_client = client
+            # state goes through the coalescing publisher as in production,
+            # so mqtt_publishes counts what actually reaches the broker
+            pwrmgmt.state_publisher = StatePublisher.from_config(client, sim_config)
+            publisher = loop.create_task(pump_publisher(pwrmgmt.state_publisher))
+            api = ecoflow_api.EcoFlowAPI(cloud.url, 'sim', 'sim', SIM_SN, pwrmgmt.on_status_update,
+                                         pwrmgmt.http_transport)
+            asyncio.set_event_loop(loop)
+            wall_start = time.perf_counter()
+            controller = loop.create_task(pwrmgmt.run_controller(sim_config, api, client))
+            with contextlib.redirect_stdout(io.StringIO()):
+                loop.run_until_complete(drive(plant, trace, broker, results, controller))
+            publisher.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                loop.run_until_complete(publisher)
+            wall = time.perf_counter() - wall_start
+            pwrmgmt.http_transport.close()
+    finally:
+        pwrmgmt.time, pwrmgmt.datetime, ecoflow_api.time, circuit_breaker.time, mqtt_publisher.time = saved
+        pwrmgmt.process_power_in, pwrmgmt.set_battery_output = originals
+        asyncio.set_event_loop(None)
+        loop.close()
+    results.finish()
+    return {
+        'scenario': name,
+        'simulated_s': len(trace),
+        'wall_s': round(wall, 2),
+        'grid_import_kwh': round(results.import_wh / 1000, 3),
+        'grid_export_kwh': round(results.export_wh / 1000, 3),
+        'cloud_writes': counters.get('quota', 0),
+        'cloud_requests': sum(v for k, v in counters.items() if k != 'tasmota'),
+        'meter_requests': counters.get('tasmota', 0),
+        'mqtt_publishes': sum(broker.published.values()),
+        'load_steps': len(results.settle_times) + results.unsettled,
+        'settle_median_s': statistics.median(results.settle_times) if results.settle_times else None,
+        'settle_max_s': max(results.settle_times) if results.settle_times else None,
+        'unsettled_steps': results.unsettled,
+        'reaction_p50_s': percentile(results.reaction_latencies, 50),
+        'reaction_p90_s': percentile(results.reaction_latencies, 90),
+        'reaction_p99_s': percentile(results.reaction_latencies, 99),
+        'decision_p50_us': round(percentile(results.decision_costs, 50) * 1e6, 1) if results.decision_costs else None,
+        'decision_p99_us': round(percentile(results.decision_costs, 99) * 1e6, 1) if results.decision_costs else None,
+    }
+
+class SimConfig(dict):
+    def __init__(self, config, **overrides):
+        super().__init__(SIM_CONFIG)
+        self.update(config)
+        self.update(overrides)
+
+    def get(self, key, default=None):
+        return dict.get(self, key, default)
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay meter/PV traces against the controller")
+    parser.add_argument('scenarios', nargs='*', default=list(SCENARIOS),
+                        help=f"synthetic scenarios to run ({', '.join(SCENARIOS)})")
+    parser.add_argument('--recording', help="replay a telemetry_recorder directory instead")
+    parser.add_argument('--config', help="config.yaml whose controller settings to use")
+    parser.add_argument('--controller', help="controller type to use (integrator, pi, feedforward)")
+    parser.add_argument('--noise', type=float, default=0, help="meter noise standard deviation in watts")
+    parser.add_argument('--json', help="write results as JSON to this file")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    config = {}
+    if args.config:
+        from config_handler import ConfigHandler
+        config = ConfigHandler(args.config).config
+    if args.controller:
+        config['controller'] = dict(config.get('controller') or {}, type=args.controller)
+
+    if args.recording:
+        start, trace = recorded_trace(args.recording)
+        runs = [('recording', start, trace)]
+    else:
+        runs = [(name, SIM_START + SCENARIOS[name][1], SCENARIOS[name][0]()) for name in args.scenarios]
+
+    results = []
+    for name, start, trace in runs:
+        result = run_scenario(name, trace, config, start=start, noise=args.noise)
+        results.append(result)
+        print(f"{name}:")
+        for key, value in result.items():
+            if key != 'scenario':
+                print(f"  {key:18} {value}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
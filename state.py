@@ -0,0 +1,108 @@
+import json
+import logging
+import math
+import os
+import tempfile
+import threading
+
+# Controller state shared between paho's network thread, executor threads
+# and the event loop. A StateStore holds an immutable snapshot; writers
+# publish a new one under a lock (copy on write), readers take snapshot()
+# without locking and always see a consistent set of values. Every field
+# carries the time it was written, so staleness checks are a subtraction.
+
+def timestamped(fields):
+    # slots of a snapshot class: the fields plus a <field>_time for each
+    return tuple(fields) + tuple(f"{field}_time" for field in fields)
+
+class Snapshot:
+    FIELDS = ()
+    DEFAULTS = {}
+    __slots__ = ()
+
+    def __init__(self, previous=None, now=0, changes=None):
+        changes = changes or {}
+        for field in self.FIELDS:
+            stamp = f"{field}_time"
+            if field in changes:
+                setattr(self, field, changes[field])
+                setattr(self, stamp, now)
+            elif previous is not None:
+                setattr(self, field, getattr(previous, field))
+                setattr(self, stamp, getattr(previous, stamp))
+            else:
+                setattr(self, field, self.DEFAULTS.get(field))
+                setattr(self, stamp, 0)
+        self.derive()
+
+    def derive(self):
+        # hook for fields computed from others, so they can never disagree
+        pass
+
+    def age(self, field, now):
+        # seconds since the field was written, inf while it is unknown
+        if getattr(self, field) is None:
+            return math.inf
+        return now - getattr(self, f"{field}_time")
+
+    def as_dict(self):
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    def stamps(self):
+        return {field: getattr(self, f"{field}_time") for field in self.FIELDS}
+
+class SiteState(Snapshot):
+    # one writer per field: current_power by process_power_in, the HA
+    # command fields by on_message, the SoC/PV totals by update_site_totals
+    FIELDS = ('current_power', 'injection_permitted', 'car_charging',
+              'soc', 'pv1_power', 'pv2_power', 'total_power_generation')
+    DEFAULTS = {'current_power': 0, 'injection_permitted': True, 'car_charging': 0}
+    __slots__ = timestamped(FIELDS)
+
+class StateStore:
+    __slots__ = ('current', 'lock')
+
+    def __init__(self, snapshot_class):
+        self.current = snapshot_class()
+        self.lock = threading.Lock()
+
+    def snapshot(self):
+        return self.current
+
+    def publish(self, now, **changes):
+        with self.lock:
+            self.current = type(self.current)(self.current, now, changes)
+            return self.current
+
+    def update(self, now, compute):
+        # for values derived from other state: compute(snapshot) -> changes
+        # runs under the lock, so concurrent updates cannot publish stale sums
+        with self.lock:
+            self.current = type(self.current)(self.current, now, compute(self.current))
+            return self.current
+
+def save_json_atomic(path, data):
+    # written to a temporary file next to path and renamed over it, so a
+    # crash or power cut leaves either the old or the new state, never half
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temporary = tempfile.mkstemp(prefix='.state-', dir=directory)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, path)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.unlink(temporary)
+        raise
+
+def load_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logging.warning("Ignoring unreadable state file %s: %s", path, e)
+        return None
@@ -0,0 +1,100 @@
+import asyncio
+import logging
+
+import metrics
+
+# Keeps the controller's asyncio workers running. A worker that raises is
+# restarted after an exponential backoff; a worker with a heartbeat_timeout
+# must call its beat() at least that often, otherwise it is considered hung,
+# cancelled and restarted. Workers are checked every check_interval seconds,
+# so a dead meter or telemetry loop is noticed within that time rather than
+# when its data has gone stale.
+
+DEFAULT_CHECK_INTERVAL = 0.5
+DEFAULT_RESTART_BACKOFF = 1
+DEFAULT_MAX_RESTART_BACKOFF = 60
+
+class Worker:
+    def __init__(self, name, factory, heartbeat_timeout=None):
+        self.name = name
+        self.factory = factory  # factory(beat) -> coroutine
+        self.heartbeat_timeout = heartbeat_timeout
+        self.task = None
+        self.started_at = 0
+        self.last_beat = 0
+        self.failures = 0
+        self.restart_at = None
+
+    def beat(self):
+        self.last_beat = asyncio.get_running_loop().time()
+
+    def start(self, loop):
+        self.started_at = self.last_beat = loop.time()
+        self.restart_at = None
+        self.task = loop.create_task(self.factory(self.beat), name=self.name)
+
+class Supervisor:
+    def __init__(self, check_interval=DEFAULT_CHECK_INTERVAL, restart_backoff=DEFAULT_RESTART_BACKOFF,
+                 max_restart_backoff=DEFAULT_MAX_RESTART_BACKOFF):
+        self.check_interval = check_interval
+        self.restart_backoff = restart_backoff
+        self.max_restart_backoff = max_restart_backoff
+        self.workers = []
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            check_interval=config.get('supervisor_interval', DEFAULT_CHECK_INTERVAL),
+            restart_backoff=config.get('restart_backoff', DEFAULT_RESTART_BACKOFF),
+            max_restart_backoff=config.get('max_restart_backoff', DEFAULT_MAX_RESTART_BACKOFF)
+        )
+
+    def add(self, name, factory, heartbeat_timeout=None):
+        worker = Worker(name, factory, heartbeat_timeout)
+        self.workers.append(worker)
+        return worker
+
+    def failed(self, worker, now, reason, exception=None):
+        # a worker that ran for a while before failing starts over with the
+        # shortest backoff
+        if now - worker.started_at >= self.max_restart_backoff:
+            worker.failures = 0
+        delay = min(self.restart_backoff * 2 ** worker.failures, self.max_restart_backoff)
+        worker.failures += 1
+        worker.restart_at = now + delay
+        metrics.inc('worker_restarts', worker=worker.name)
+        logging.error("Worker %s %s, restarting in %ss", worker.name, reason, delay, exc_info=exception)
+
+    def check(self, loop):
+        now = loop.time()
+        for worker in self.workers:
+            if worker.restart_at is not None:
+                if now >= worker.restart_at:
+                    worker.start(loop)
+                continue
+            task = worker.task
+            if task.done():
+                if task.cancelled():
+                    self.failed(worker, now, "was cancelled")
+                elif task.exception() is not None:
+                    exception = task.exception()
+                    self.failed(worker, now, f"failed: {type(exception).__name__}: {exception}", exception)
+                # one-shot workers that returned normally are done
+            elif worker.heartbeat_timeout is not None and now - worker.last_beat > worker.heartbeat_timeout:
+                metrics.inc('worker_stalls', worker=worker.name)
+                task.cancel()
+                self.failed(worker, now, f"missed its heartbeat for {now - worker.last_beat:.1f}s")
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        for worker in self.workers:
+            worker.start(loop)
+        try:
+            while True:
+                await asyncio.sleep(self.check_interval)
+                self.check(loop)
+        finally:
+            tasks = [worker.task for worker in self.workers if worker.task is not None]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
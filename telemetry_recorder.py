@@ -0,0 +1,215 @@
+import argparse
+import csv
+import logging
+import math
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import metrics
+
+# timestamp, power_in, setpoint, min_power, max_power, soc, pv1, pv2
+RECORD = struct.Struct('<d7f')
+FIELDS = ('timestamp', 'power_in', 'setpoint', 'min_power', 'max_power', 'soc', 'pv1', 'pv2')
+SEGMENT_PREFIX = 'telemetry-'
+SEGMENT_SUFFIX = '.bin'
+
+DEFAULT_SEGMENT_RECORDS = 86400
+DEFAULT_RETENTION_DAYS = 365
+FLUSH_INTERVAL = 10
+
+if np is not None:
+    RECORD_DTYPE = np.dtype([('timestamp', '<f8')] + [(name, '<f4') for name in FIELDS[1:]])
+
+def segment_paths(directory):
+    names = sorted(name for name in os.listdir(directory)
+                   if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX))
+    return [os.path.join(directory, name) for name in names]
+
+def used_records(buf, capacity):
+    # segments are preallocated with zeros and filled front to back, so the
+    # first record with a zero timestamp marks the end of the data
+    lo, hi = 0, capacity
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if RECORD.unpack_from(buf, mid * RECORD.size)[0] != 0:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+class TelemetryRecorder:
+    def __init__(self, directory, segment_records=DEFAULT_SEGMENT_RECORDS,
+                 retention_days=DEFAULT_RETENTION_DAYS, queue_size=10000):
+        self.directory = directory
+        self.segment_records = segment_records
+        self.retention_days = retention_days
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.dropped = 0
+        self.dropped_reported = 0
+        self.file = None
+        self.map = None
+        self.position = 0
+        self.thread = None
+        os.makedirs(directory, exist_ok=True)
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            config.get('recorder_dir'),
+            segment_records=config.get('recorder_segment_records', DEFAULT_SEGMENT_RECORDS),
+            retention_days=config.get('recorder_retention_days', DEFAULT_RETENTION_DAYS)
+        )
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='telemetry-recorder', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.queue.put(None)
+        if self.thread:
+            self.thread.join()
+
+    def record(self, power_in, setpoint, min_power, max_power, soc, pv1, pv2, timestamp=None):
+        # never blocks the caller; if the writer can't keep up records are dropped
+        values = (timestamp or time.time(), power_in, setpoint, min_power, max_power, soc, pv1, pv2)
+        try:
+            self.queue.put_nowait(tuple(math.nan if v is None else v for v in values))
+        except queue.Full:
+            self.dropped += 1
+            metrics.inc('recorder_dropped')
+
+    def open_segment(self):
+        paths = segment_paths(self.directory)
+        if paths:
+            # continue the newest segment if it still has room
+            path = paths[-1]
+            self.file = open(path, 'r+b')
+            self.map = mmap.mmap(self.file.fileno(), 0)
+            capacity = len(self.map) // RECORD.size
+            self.position = used_records(self.map, capacity)
+            if self.position < capacity:
+                return
+            self.close_segment()
+        stamp = int(time.time() * 1000)
+        if paths:
+            # names must sort in write order even if segments fill up within a millisecond
+            stamp = max(stamp, int(os.path.basename(paths[-1])[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)]) + 1)
+        path = os.path.join(self.directory, f"{SEGMENT_PREFIX}{stamp:015d}{SEGMENT_SUFFIX}")
+        self.file = open(path, 'w+b')
+        self.file.truncate(self.segment_records * RECORD.size)
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        self.position = 0
+        self.apply_retention()
+
+    def close_segment(self):
+        if self.map is not None:
+            self.map.flush()
+            self.map.close()
+            self.file.close()
+            self.map = self.file = None
+
+    def apply_retention(self):
+        cutoff = time.time() - self.retention_days * 86400
+        # the newest segment is the one being written and is always kept
+        for path in segment_paths(self.directory)[:-1]:
+            if os.path.getmtime(path) < cutoff:
+                logging.info("Removing expired telemetry segment %s", path)
+                os.remove(path)
+
+    def write(self, values):
+        if self.map is None or self.position * RECORD.size >= len(self.map):
+            self.close_segment()
+            self.open_segment()
+        RECORD.pack_into(self.map, self.position * RECORD.size, *values)
+        self.position += 1
+
+    def report_dropped(self):
+        # at most once per flush, whatever the number of records lost
+        dropped = self.dropped
+        if dropped > self.dropped_reported:
+            logging.warning("Telemetry recorder fell behind, %s records dropped (%s in total)",
+                            dropped - self.dropped_reported, dropped)
+            self.dropped_reported = dropped
+
+    def run(self):
+        last_flush = time.monotonic()
+        while True:
+            try:
+                values = self.queue.get(timeout=FLUSH_INTERVAL)
+            except queue.Empty:
+                values = ()
+            if values is None:
+                self.close_segment()
+                return
+            try:
+                if values:
+                    self.write(values)
+                if self.map is not None and time.monotonic() - last_flush >= FLUSH_INTERVAL:
+                    self.map.flush()
+                    last_flush = time.monotonic()
+                    self.report_dropped()
+            except (OSError, ValueError) as e:
+                logging.error("Telemetry recorder failed to write: %s", e)
+                self.close_segment()
+
+# query/export API - works on the segment files and can be used while the
+# recorder is writing to them
+
+def iter_records(directory, start=None, end=None):
+    for path in segment_paths(directory):
+        with open(path, 'rb') as f:
+            data = f.read()
+        count = used_records(data, len(data) // RECORD.size)
+        for values in RECORD.iter_unpack(data[:count * RECORD.size]):
+            if start is not None and values[0] < start:
+                continue
+            if end is not None and values[0] >= end:
+                return
+            yield values
+
+def to_numpy(directory, start=None, end=None):
+    if np is None:
+        raise RuntimeError("numpy is required for to_numpy()")
+    chunks = []
+    for path in segment_paths(directory):
+        data = np.fromfile(path, dtype=RECORD_DTYPE)
+        unused = np.flatnonzero(data['timestamp'] == 0)
+        if len(unused):
+            data = data[:unused[0]]
+        if start is not None:
+            data = data[data['timestamp'] >= start]
+        if end is not None:
+            data = data[data['timestamp'] < end]
+        if len(data):
+            chunks.append(data)
+    if not chunks:
+        return np.empty(0, dtype=RECORD_DTYPE)
+    return np.concatenate(chunks)
+
+def export_csv(directory, output, start=None, end=None):
+    with open(output, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(FIELDS)
+        count = 0
+        for values in iter_records(directory, start, end):
+            writer.writerow(values)
+            count += 1
+    return count
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export recorded controller telemetry to CSV")
+    parser.add_argument('directory')
+    parser.add_argument('output')
+    parser.add_argument('--start', type=float, help="unix timestamp of the first record")
+    parser.add_argument('--end', type=float, help="unix timestamp after the last record")
+    args = parser.parse_args()
+    print(f"exported {export_csv(args.directory, args.output, args.start, args.end)} records")